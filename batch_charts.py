@@ -0,0 +1,180 @@
+# Headless batch mode of the Data Visualization page: generate charts for many questions without the UI.
+# Reads one job per line of a JSONL file:
+#
+#   {"id": "movies-ratings", "dataset": "Movies", "question": "Plot the average rating per genre", "model": "gpt-4"}
+#
+# "id" is optional (a hash of the job is used) and may only hold letters, digits, "_" and "-".  "model"
+# defaults to gpt-3.5-turbo and can also be a label shown on the page such as "ChatGPT-4".  For every job the script and the image go to
+# <output>/<id>/script.py and <output>/<id>/chart.<format>, and one line with the outcome and the timing
+# of every stage is appended to <output>/results.jsonl.  Running again with the same output directory
+# skips the jobs which already succeeded, so an interrupted batch carries on where it stopped.
+#
+#   python batch_charts.py jobs.jsonl lessons/
+#   python batch_charts.py jobs.jsonl lessons/ --workers 8 --format svg --retry-failed
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Jobs run at the same time, each one holds a request to OpenAI and then a plotting worker
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "4"))
+# Labels used on the Data Visualization page, accepted as well as the model names
+MODEL_LABELS = {"ChatGPT-4": "gpt-4", "ChatGPT-3.5": "gpt-3.5-turbo"}
+DEFAULT_MODEL = "gpt-3.5-turbo"
+RESULTS_FILE = "results.jsonl"
+# Ids name the job's directory under the output directory, so path separators and dots are refused
+JOB_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+
+_results_lock = threading.Lock()
+
+
+def job_id(job):
+    # The id given in the job, or a stable hash of what it asks for
+    if job.get("id"):
+        return str(job["id"])
+    text = "\x1f".join([job["dataset"], job["question"], job.get("model", DEFAULT_MODEL)])
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+def read_jobs(path):
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            if "dataset" not in job or "question" not in job:
+                raise ValueError("Line " + str(line_no) + " of " + path + " needs a dataset and a question.")
+            job["id"] = job_id(job)
+            if not JOB_ID_PATTERN.fullmatch(job["id"]):
+                raise ValueError("Line " + str(line_no) + " of " + path + " has the id " + json.dumps(job["id"])
+                                 + ", ids may only use letters, digits, _ and -.")
+            jobs.append(job)
+    return jobs
+
+
+def finished_jobs(output_dir, retry_failed):
+    # Ids already in results.jsonl, only the successful ones when failed jobs are to be retried
+    done = set()
+    path = os.path.join(output_dir, RESULTS_FILE)
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # A line cut short when the batch was interrupted
+                continue
+            if result.get("status") == "ok" or not retry_failed:
+                done.add(result["id"])
+    return done
+
+
+def _write_atomic(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def run_job(job, output_dir, image_format, use_cache):
+    # Same steps as the Go... button: primer, question, model, then the script drawn in a plotting worker
+    from classes import get_primer, format_question, run_request, count_tokens
+    from dataset_registry import registry, BUILTIN_DATASETS
+    from plot_worker import render_script
+    from response_cache import response_cache
+    from tracing import trace, span
+
+    model_label = job.get("model", DEFAULT_MODEL)
+    model_type = MODEL_LABELS.get(model_label, model_label)
+    result = {"id": job["id"], "dataset": job["dataset"], "question": job["question"], "model": model_type}
+    with trace("batch_chart", session="batch") as current:
+        try:
+            if model_type not in MODEL_LABELS.values():
+                raise ValueError("Unknown model " + model_label + ", choose one of " + ", ".join(MODEL_LABELS.values()))
+            if job["dataset"] not in BUILTIN_DATASETS:
+                raise KeyError("Unknown dataset " + job["dataset"] + ", choose one of " + ", ".join(BUILTIN_DATASETS))
+            dataset_key = "builtin:" + job["dataset"]
+            with span("dataset"):
+                df = registry.get(dataset_key)
+            with span("primer"):
+                primer1, primer2 = get_primer(df, 'datasets["' + job["dataset"] + '"]', None, job["question"], model_type)
+            question = format_question(primer1, primer2, job["question"], model_label)
+            result["prompt_tokens"] = count_tokens(question, model_type)
+            script = primer2 + run_request(question, model_type, use_cache=use_cache)
+            job_dir = os.path.join(output_dir, job["id"])
+            os.makedirs(job_dir, exist_ok=True)
+            _write_atomic(os.path.join(job_dir, "script.py"), script.encode("utf-8"))
+            try:
+                with span("render"):
+                    image = render_script(script, {job["dataset"]: dataset_key}, image_format)
+            except Exception:
+                # A script which does not run is not kept, a retry asks the model again
+                response_cache.delete(question, model_type)
+                raise
+            image_name = "chart." + image_format
+            _write_atomic(os.path.join(job_dir, image_name), image)
+            result.update(status="ok", script=os.path.join(job["id"], "script.py"),
+                          image=os.path.join(job["id"], image_name))
+        except Exception as error:
+            result.update(status="error", error=type(error).__name__ + ": " + str(error))
+    record = current.to_dict()
+    result["seconds"] = record["seconds"]
+    result["stages"] = {s["name"]: s["seconds"] for s in record["spans"]}
+    result["tokens"] = record["tokens"]
+    # The result line is written last, so a job only counts as done once its files are complete
+    with _results_lock:
+        with open(os.path.join(output_dir, RESULTS_FILE), "a", encoding="utf-8") as f:
+            f.write(json.dumps(result) + "\n")
+    return result
+
+
+def run_batch(jobs, output_dir, workers=BATCH_WORKERS, image_format="png", retry_failed=False, use_cache=True):
+    # Run the jobs which are not finished yet, at most workers at a time, and return their results
+    os.makedirs(output_dir, exist_ok=True)
+    done = finished_jobs(output_dir, retry_failed)
+    todo = [job for job in jobs if job["id"] not in done]
+    print(str(len(jobs) - len(todo)) + " of " + str(len(jobs)) + " jobs already done, running " + str(len(todo)) + ".")
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="batch_chart") as pool:
+        for result in pool.map(lambda job: run_job(job, output_dir, image_format, use_cache), todo):
+            results.append(result)
+            print("%-14s %-6s %7.2fs  %s" % (result["id"], result["status"], result["seconds"],
+                                             result.get("error", result.get("image", ""))))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate charts for a file of (dataset, question, model) jobs.")
+    parser.add_argument("jobs", help="JSONL file with one job per line")
+    parser.add_argument("output", help="directory for the scripts, images and results.jsonl")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="jobs run at the same time")
+    parser.add_argument("--format", default="png", choices=["png", "svg"], help="image format")
+    parser.add_argument("--retry-failed", action="store_true", help="run the jobs which failed last time again")
+    parser.add_argument("--no-cache", action="store_true", help="ask the model even if the answer is cached")
+    args = parser.parse_args()
+
+    jobs = read_jobs(os.path.abspath(args.jobs))
+    output_dir = os.path.abspath(args.output)
+    # The bundled datasets and the caches are found relative to the app, as when it runs under Streamlit
+    os.chdir(ROOT)
+    sys.path.append(ROOT)
+    started = time.perf_counter()
+    results = run_batch(jobs, output_dir, args.workers, args.format, args.retry_failed, not args.no_cache)
+    failed = sum(1 for result in results if result["status"] != "ok")
+    print("Ran " + str(len(results)) + " jobs in %.1fs, %d failed." % (time.perf_counter() - started, failed))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
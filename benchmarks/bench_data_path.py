@@ -0,0 +1,198 @@
+# Micro-benchmarks for classes.py and the dataset path behind the Go... button.
+# Runs offline: no request is sent to OpenAI.
+#
+#   python benchmarks/bench_data_path.py                  run and print the results
+#   python benchmarks/bench_data_path.py --save           also store them as the baseline
+#   python benchmarks/bench_data_path.py --compare        fail if a stage got slower than the baseline
+#   python benchmarks/bench_data_path.py --quick          smaller synthetic datasets
+#
+# benchmarks/baseline.json is committed, timings depend on the machine so run --save on yours before
+# comparing against it there.
+import argparse
+import gc
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+import classes  # noqa: E402
+import dataset_registry  # noqa: E402
+
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baseline.json")
+# A stage counts as a regression when it is this much slower than the baseline
+REGRESSION_RATIO = 1.5
+# Differences below this many milliseconds are noise
+NOISE_MS = 0.5
+
+SAMPLE_RESPONSE = ("import pandas as pd\nimport matplotlib.pyplot as plt\n"
+                   "df = pd.read_csv('data_file.csv')\n"
+                   "df.groupby('Genre')['IMDB Rating'].mean().plot(kind='bar', ax=ax)\n"
+                   "ax.set_title('Average rating')\nplt.show()\n")
+
+
+def synthetic_dataset(rows, columns, cardinality, seed=0):
+    # Half text columns drawing from `cardinality` labels, half numeric columns
+    rng = np.random.default_rng(seed)
+    data = {}
+    for i in range(columns):
+        if i % 2 == 0:
+            labels = np.array(["label_" + str(j) for j in range(cardinality)], dtype=object)
+            data["text_" + str(i)] = labels[rng.integers(0, cardinality, rows)]
+        elif i % 4 == 1:
+            data["int_" + str(i)] = rng.integers(0, 10000, rows)
+        else:
+            data["float_" + str(i)] = rng.random(rows)
+    return pd.DataFrame(data)
+
+
+def measure(func, repeat):
+    # Median latency in ms over repeat runs, and the peak memory in MB of one run
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"ms": round(statistics.median(times), 4), "peak_mb": round(peak / 1024 / 1024, 3)}
+
+
+def bench_dataset(name, df, csv_path, repeat):
+    results = {}
+    cache_dir = tempfile.mkdtemp(prefix="bench_datasets_")
+    try:
+        if csv_path is not None:
+            results["read_csv"] = measure(lambda: pd.read_csv(csv_path), repeat)
+
+            def registry_cold():
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                registry = dataset_registry.DatasetRegistry(cache_dir=cache_dir)
+                registry._load("bench", lambda: pd.read_csv(csv_path))
+            results["registry_cold"] = measure(registry_cold, repeat)
+            # The columnar cache is left behind by the last cold run
+            results["registry_warm"] = measure(
+                lambda: dataset_registry.DatasetRegistry(cache_dir=cache_dir)._load("bench", None), repeat)
+        results["compact"] = measure(lambda: dataset_registry.compact_dataset(df.copy()), repeat)
+
+        def fingerprint_cold():
+            classes.clear_profile_cache()
+            classes.dataset_fingerprint(df)
+        results["fingerprint_cold"] = measure(fingerprint_cold, repeat)
+
+        def primer_cold():
+            classes.clear_profile_cache()
+            classes.get_primer(df, 'datasets["' + name + '"]')
+        results["get_primer_cold"] = measure(primer_cold, repeat)
+        classes.get_primer(df, 'datasets["' + name + '"]')
+        results["get_primer_warm"] = measure(lambda: classes.get_primer(df, 'datasets["' + name + '"]'), repeat * 10)
+        # Fitted to the smallest model budget, with the profile already cached
+        results["get_primer_budget"] = measure(lambda: classes.get_primer(
+            df, 'datasets["' + name + '"]', None, "Plot the average of each column", "gpt-3.5-turbo"), repeat * 10)
+
+        primer1, primer2 = classes.get_primer(df, 'datasets["' + name + '"]')
+        results["format_question"] = measure(
+            lambda: classes.format_question(primer1, primer2, "Plot the average of each column", "gpt-4"), repeat * 10)
+        results["format_response"] = measure(lambda: classes.format_response(SAMPLE_RESPONSE), repeat * 10)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+
+def run(quick, repeat):
+    results = {}
+    for name, file_name in dataset_registry.BUILTIN_DATASETS.items():
+        csv_path = os.path.join(ROOT, file_name)
+        results["bundled/" + name] = bench_dataset(name, pd.read_csv(csv_path), csv_path, repeat)
+
+    row_counts = [1000, 10000, 100000] if quick else [1000, 10000, 100000, 1000000]
+    column_counts = [10, 50, 200] if quick else [10, 50, 200, 500]
+    cardinalities = [5, 50, 5000] if quick else [5, 50, 5000, 50000]
+    temp_dir = tempfile.mkdtemp(prefix="bench_csv_")
+    try:
+        cases = [("rows", rows, 20, 10) for rows in row_counts]
+        cases += [("columns", 10000, columns, 10) for columns in column_counts]
+        cases += [("cardinality", row_counts[-2], 20, cardinality) for cardinality in cardinalities]
+        for axis, rows, columns, cardinality in cases:
+            name = "synthetic/%s/r%d_c%d_k%d" % (axis, rows, columns, cardinality)
+            df = synthetic_dataset(rows, columns, cardinality)
+            csv_path = os.path.join(temp_dir, "synthetic.csv")
+            df.to_csv(csv_path, index=False)
+            results[name] = bench_dataset(name, pd.read_csv(csv_path), csv_path, repeat)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, ratio=REGRESSION_RATIO):
+    # List of (dataset, stage, baseline ms, now ms) for every stage which got slower
+    regressions = []
+    for dataset, stages in results.items():
+        for stage, now in stages.items():
+            before = baseline.get(dataset, {}).get(stage)
+            if before is None:
+                continue
+            if now["ms"] > before["ms"] * ratio and now["ms"] - before["ms"] > NOISE_MS:
+                regressions.append((dataset, stage, before["ms"], now["ms"]))
+    return regressions
+
+
+def print_results(results):
+    print("%-45s %-18s %12s %10s" % ("dataset", "stage", "median ms", "peak MB"))
+    for dataset, stages in results.items():
+        for stage, result in stages.items():
+            print("%-45s %-18s %12.3f %10.3f" % (dataset, stage, result["ms"], result["peak_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark classes.py and the dataset path.")
+    parser.add_argument("--quick", action="store_true", help="skip the largest synthetic datasets")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per stage, the median is reported")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="exit with 1 if a stage is slower than the baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file")
+    parser.add_argument("--ratio", type=float, default=REGRESSION_RATIO,
+                        help="how many times slower than the baseline a stage may get")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+    # Fail before the slow part when there is nothing to compare against
+    if args.compare and not os.path.exists(args.baseline):
+        print("No baseline at " + args.baseline + ", run with --save first.")
+        sys.exit(1)
+
+    results = run(args.quick, args.repeat)
+    print_results(results)
+    report = {"python": sys.version.split()[0], "pandas": pd.__version__, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.ratio)
+        for dataset, stage, before, now in regressions:
+            print("REGRESSION %s %s: %.3f ms -> %.3f ms" % (dataset, stage, before, now))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against " + args.baseline)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=1)
+        print("Baseline saved to " + args.baseline)
+
+
+if __name__ == "__main__":
+    main()
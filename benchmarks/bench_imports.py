@@ -0,0 +1,134 @@
+# Import-time profile of the app modules and pages, each measured in a fresh interpreter.
+# Runs offline: importing a module must never build a client or send a request.
+#
+#   python benchmarks/bench_imports.py                    median import time of every group
+#   python benchmarks/bench_imports.py --top 15           also list the slowest modules behind each group
+#   python benchmarks/bench_imports.py --target 1500      exit with 1 if a group takes longer than this many ms
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What each page (or shared module) imports before it draws anything
+GROUPS = {
+    "tracing": ["tracing"],
+    "llm_client": ["llm_client"],
+    "classes": ["classes"],
+    "dataset_registry": ["dataset_registry"],
+    "chat_store": ["chat_store"],
+    "similar_replies": ["similar_replies"],
+    "dictionary": ["dictionary"],
+    "downsampling": ["downsampling"],
+    "chat_page": ["streamlit", "langchain.chains", "langchain.prompts", "llm_client", "streaming",
+                  "moderation", "tracing", "chat_memory", "chat_store", "similar_replies", "dictionary"],
+    "visualization_page": ["streamlit", "classes", "dataset_registry", "plot_worker", "figure_cache",
+                           "response_cache", "tracing"],
+}
+# Modules which must stay out of a group's import tree, the pages load them only when they are used
+FORBIDDEN = {
+    "tracing": ["langchain_core", "openai", "streamlit"],
+    "llm_client": ["openai", "httpx", "langchain_openai"],
+    "classes": ["openai", "langchain", "matplotlib", "seaborn", "streamlit"],
+    "dataset_registry": ["matplotlib", "seaborn", "streamlit"],
+    "chat_store": ["langchain", "openai", "streamlit"],
+    "similar_replies": ["langchain", "openai", "streamlit"],
+    "dictionary": ["langchain", "openai", "streamlit"],
+    "downsampling": ["matplotlib", "pandas", "seaborn"],
+    "chat_page": ["langchain.memory", "langchain_openai", "openai", "matplotlib"],
+    "visualization_page": ["langchain", "openai", "matplotlib", "seaborn"],
+}
+# Slowest group allowed, in ms above a bare interpreter
+IMPORT_TARGET_MS = float(os.environ.get("IMPORT_TARGET_MS", "2000"))
+
+
+def _python(code, *flags):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    env.pop("OPENAI_API_KEY", None)
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=ROOT, env=env,
+                          capture_output=True, text=True)
+
+
+def _import_code(modules):
+    return "".join("import " + module + "\n" for module in modules)
+
+
+def time_group(modules, repeat):
+    # Median wall time in ms of a fresh interpreter importing modules
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = _python(_import_code(modules))
+        times.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            raise RuntimeError("Importing " + ", ".join(modules) + " failed.\n" + result.stderr)
+    return statistics.median(times)
+
+
+def loaded_modules(modules):
+    code = _import_code(modules) + "import json, sys\nprint(json.dumps(sorted(sys.modules)))\n"
+    result = _python(code)
+    if result.returncode != 0:
+        raise RuntimeError("Importing " + ", ".join(modules) + " failed.\n" + result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _importtime(modules):
+    # {module: cumulative ms} of the top-level imports, from python -X importtime
+    result = _python(_import_code(modules), "-X", "importtime")
+    costs = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        # Only direct children of the group, nested imports are included in their parent
+        if match and len(match.group(3)) <= 2:
+            costs[match.group(4)] = int(match.group(2)) / 1000
+    return costs
+
+
+def slowest_imports(modules, top):
+    # (cumulative ms, module) of the imports which cost the most, leaving out the interpreter's own startup
+    startup = _importtime([])
+    costs = [(ms, module) for module, ms in _importtime(modules).items() if module not in startup]
+    return sorted(costs, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the import time of the app modules and pages.")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per group, the median is reported")
+    parser.add_argument("--top", type=int, default=0, help="list this many of the slowest imports of each group")
+    parser.add_argument("--target", type=float, default=IMPORT_TARGET_MS,
+                        help="exit with 1 if a group takes longer than this many ms")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    bare = time_group([], args.repeat)
+    results = {}
+    failed = False
+    print("%-20s %12s  %s" % ("group", "import ms", "eager imports"))
+    for name, modules in GROUPS.items():
+        ms = time_group(modules, args.repeat) - bare
+        loaded = loaded_modules(modules)
+        eager = [module for module in FORBIDDEN.get(name, [])
+                 if module in loaded or any(m.startswith(module + ".") for m in loaded)]
+        results[name] = {"ms": round(ms, 1), "eager": eager}
+        print("%-20s %12.1f  %s" % (name, ms, ", ".join(eager) or "-"))
+        if ms > args.target or eager:
+            failed = True
+        for cost, module in slowest_imports(modules, args.top) if args.top else []:
+            print("    %10.1f  %s" % (cost, module))
+    print("bare interpreter %.1f ms, target %.0f ms" % (bare, args.target))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version.split()[0], "bare_ms": round(bare, 1), "results": results}, f, indent=1)
+    if failed:
+        print("Import time over the target or heavy modules imported eagerly.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
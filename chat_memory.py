@@ -0,0 +1,103 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import span, observe
+
+# Threads which fold new exchanges into the running summaries, off the request path
+_summary_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="chat_memory")
+
+
+class SessionMemory:
+    # Conversation memory for one chat session, kept in st.session_state between reruns.
+    # Holds a running summary plus the exchanges which have not been summarized yet.
+    # add_exchange() folds only the newest exchange into the summary, in a background thread,
+    # so each turn costs at most one summarization call and the reply never waits for it.
+    # Given a chat_store.ChatStore and a conversation key, the summary is saved there and read back
+    # when the memory is created again for that conversation.
+
+    def __init__(self, store=None, conversation=None):
+        self.store = store
+        self.conversation = conversation
+        self.summary = ""
+        self.pending = []
+        if store is not None:
+            self.summary, self.pending = store.load_summary(conversation)
+        self._running = False
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        # The summary followed by any exchanges still waiting to be summarized
+        with span("memory_load"):
+            with self._lock:
+                summary, pending = self.summary, list(self.pending)
+            return "\n".join([summary] + _format_lines(pending)).strip()
+
+    def add_exchange(self, llm, question, answer):
+        with self._lock:
+            self.pending.append((question, answer))
+            self._save()
+            if self._running:
+                # The running summarizer picks this exchange up when it finishes
+                return
+            self._running = True
+            generation = self._generation
+        _summary_pool.submit(self._fold, llm, generation)
+
+    def clear(self):
+        with self._lock:
+            self.summary = ""
+            self.pending = []
+            self._save()
+            # A summary in progress belongs to the old conversation and is thrown away
+            self._generation += 1
+            self._running = False
+
+    def _fold(self, llm, generation):
+        while True:
+            with self._lock:
+                if generation != self._generation:
+                    return
+                if not self.pending:
+                    self._running = False
+                    return
+                summary, batch = self.summary, list(self.pending)
+            started = time.perf_counter()
+            try:
+                # langchain.memory is slow to import, only load it once there is something to summarize
+                from langchain.memory.prompt import SUMMARY_PROMPT
+                prompt = SUMMARY_PROMPT.format(summary=summary, new_lines="\n".join(_format_lines(batch)))
+                new_summary = llm.invoke(prompt).content
+                # Runs outside any request, so it only goes to the process metrics
+                observe("memory_summarize", time.perf_counter() - started)
+            except Exception as error:
+                # Keep the exchanges as they are, load() still includes them word for word
+                print("Conversation summary failed.\n" + str(error))
+                with self._lock:
+                    if generation == self._generation:
+                        self._running = False
+                return
+            with self._lock:
+                if generation != self._generation:
+                    return
+                self.summary = new_summary
+                del self.pending[:len(batch)]
+                self._save()
+
+    def _save(self):
+        # Called with the lock held
+        if self.store is not None:
+            try:
+                self.store.save_summary(self.conversation, self.summary, self.pending)
+            except Exception as error:
+                # The summary is still kept in memory for this session
+                print("Conversation summary could not be saved.\n" + str(error))
+
+
+def _format_lines(exchanges):
+    lines = []
+    for question, answer in exchanges:
+        lines.append("Human: " + question)
+        lines.append("AI: " + answer)
+    return lines
@@ -0,0 +1,169 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+
+# Where conversations are kept and for how long, can be set from the environment.  A conversation only
+# lives as long as the browser session which started it, the store keeps its messages out of memory;
+# conversations idle for STORE_TTL are deleted, checked every PURGE_INTERVAL seconds.
+STORE_PATH = os.environ.get("CHAT_STORE_PATH", os.path.join(".cache", "chats.sqlite"))
+STORE_TTL = float(os.environ.get("CHAT_STORE_TTL", str(24 * 3600)))
+PURGE_INTERVAL = 600
+# Messages of a conversation kept on disk, the oldest are dropped first
+MAX_MESSAGES = int(os.environ.get("CHAT_MAX_MESSAGES", "1000"))
+# Messages each session keeps in memory and draws on every rerun, older ones are read from disk on demand
+WINDOW = int(os.environ.get("CHAT_WINDOW", "20"))
+# Older messages read per "Show earlier messages" click
+PAGE_SIZE = 20
+
+
+class ChatStore:
+    # SQLite store of chat messages and conversation summaries, shared by every session.
+    # A conversation is identified by a string key, e.g. "<session conversation id>:penpal".
+
+    def __init__(self, path=STORE_PATH, max_messages=MAX_MESSAGES, ttl=STORE_TTL):
+        self.path = path
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self._purged = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS messages (conversation TEXT, seq INTEGER, role TEXT, "
+                               "content TEXT, created REAL, PRIMARY KEY (conversation, seq))")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS summaries (conversation TEXT PRIMARY KEY, summary TEXT, "
+                               "pending TEXT, updated REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS messages_created ON messages (created)")
+        if time.time() - self._purged > PURGE_INTERVAL:
+            self._purge()
+        return self._conn
+
+    def _purge(self):
+        # Called with the lock held: forget the conversations idle for longer than ttl
+        self._purged = time.time()
+        cutoff = self._purged - self.ttl
+        self._conn.execute("DELETE FROM messages WHERE conversation IN (SELECT conversation FROM messages "
+                           "GROUP BY conversation HAVING MAX(created) < ?)", (cutoff,))
+        self._conn.execute("DELETE FROM summaries WHERE updated < ?", (cutoff,))
+        self._conn.commit()
+
+    def append(self, conversation, role, content):
+        # Add a message to the end of the conversation and return its sequence number
+        with self._lock:
+            conn = self._connect()
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM messages WHERE conversation = ?",
+                               (conversation,)).fetchone()[0]
+            conn.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                         (conversation, seq, role, str(content), time.time()))
+            conn.execute("DELETE FROM messages WHERE conversation = ? AND seq <= ?", (conversation, seq - self.max_messages))
+            conn.commit()
+            return seq
+
+    def recent(self, conversation, limit, before=None):
+        # The last limit messages of the conversation, or the last limit before sequence number before,
+        # oldest first, as dicts with seq, role and content
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT seq, role, content FROM messages WHERE conversation = ? AND seq < ? "
+                "ORDER BY seq DESC LIMIT ?", (conversation, before if before is not None else 2 ** 62, limit)).fetchall()
+        return [{"seq": seq, "role": role, "content": content} for seq, role, content in reversed(rows)]
+
+    def count(self, conversation, before=None):
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM messages WHERE conversation = ? AND seq < ?",
+                (conversation, before if before is not None else 2 ** 62)).fetchone()[0]
+
+    def load_summary(self, conversation):
+        # (summary, pending exchanges) of a conversation, empty if there is none
+        with self._lock:
+            row = self._connect().execute("SELECT summary, pending FROM summaries WHERE conversation = ?",
+                                          (conversation,)).fetchone()
+        if row is None:
+            return "", []
+        return row[0], [tuple(exchange) for exchange in json.loads(row[1])]
+
+    def save_summary(self, conversation, summary, pending):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?)",
+                         (conversation, summary, json.dumps(pending), time.time()))
+            conn.commit()
+
+    def clear(self, conversation):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM messages WHERE conversation = ?", (conversation,))
+            conn.execute("DELETE FROM summaries WHERE conversation = ?", (conversation,))
+            conn.commit()
+
+
+class ChatHistory:
+    # The messages of one conversation as seen by one session.  Only the last `window` messages are
+    # held in memory and drawn on each rerun; earlier ones are read from the store a page at a time
+    # when asked for, and dropped again once the conversation moves on.
+
+    def __init__(self, store, conversation, window=WINDOW, page_size=PAGE_SIZE):
+        self.store = store
+        self.conversation = conversation
+        self.page_size = page_size
+        self.window = deque(store.recent(conversation, window), maxlen=window)
+        self.earlier_pages = 0
+
+    def add(self, role, content):
+        seq = self.store.append(self.conversation, role, content)
+        self.window.append({"seq": seq, "role": role, "content": str(content)})
+        self.earlier_pages = 0
+
+    def _first_seq(self):
+        return self.window[0]["seq"] if self.window else None
+
+    def has_earlier(self):
+        first = self._first_seq()
+        return first is not None and self.store.count(self.conversation, first) > self.earlier_pages * self.page_size
+
+    def show_earlier(self):
+        self.earlier_pages += 1
+
+    def messages(self):
+        # The messages to draw: the window, preceded by the earlier pages asked for
+        earlier = []
+        if self.earlier_pages and self.window:
+            earlier = self.store.recent(self.conversation, self.earlier_pages * self.page_size, self._first_seq())
+        return earlier + list(self.window)
+
+    def clear(self):
+        self.store.clear(self.conversation)
+        self.window.clear()
+        self.earlier_pages = 0
+
+
+def conversation_id():
+    # One id per browser session, kept only on the server.  It is never put in the URL, where anyone
+    # given the link could read the conversation and add to it; a reload starts a new conversation.
+    import streamlit as st
+    if "chat_id" not in st.session_state:
+        st.session_state["chat_id"] = uuid.uuid4().hex
+    return st.session_state["chat_id"]
+
+
+def session_history(page):
+    # The ChatHistory of this session on one page, created once and kept in st.session_state
+    import streamlit as st
+    key = page + "_history"
+    if key not in st.session_state:
+        st.session_state[key] = ChatHistory(chat_store, conversation_id() + ":" + page)
+    return st.session_state[key]
+
+
+# Store shared by every session in the process
+chat_store = ChatStore()
@@ -1,42 +1,88 @@
 import json
-import openai
-from openai import OpenAI
-
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
+import re
+import time
+
 import sys
-from dotenv import load_dotenv, find_dotenv
+# Light modules only: the OpenAI client, langchain and the plotting libraries are imported when first used
+from llm_client import get_client
+from rate_limiter import scheduler, estimate_tokens, COMPLETION_ESTIMATE
+from response_cache import response_cache
+from single_flight import single_flight
+from tracing import span, record_tokens, run_in_context
 
-import matplotlib
-import matplotlib.pyplot as pyplot
-import streamlit as st
-import io
-import seaborn as sns
+import pandas as pd
 
-# Load API Key
 sys.path.append('../..')
-_ = load_dotenv(find_dotenv())  # read local .env file
-openai.api_key = os.environ['OPENAI_API_KEY']
 
-def run_request(question_to_ask, model_type):
+# Seconds to wait for one model before giving up on it
+MODEL_TIMEOUT = 60
+# Bounded pool of threads used to send requests to several models at once
+_request_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="run_request")
+
+def run_requests(questions, timeout=MODEL_TIMEOUT, use_cache=True):
+    # Send one request per model at the same time.  questions maps a key to (question_to_ask, model_type).
+    # Yields (key, answer, error) in the order the models finish, so the slowest model sets the wall time.
+    # A model that takes longer than timeout seconds is reported with a TimeoutError.
+    # Each request runs inside the caller's trace
+    futures = {_request_pool.submit(run_in_context(run_request), question_to_ask, model_type, timeout, use_cache): key
+               for key, (question_to_ask, model_type) in questions.items()}
+    deadline = time.monotonic() + timeout
+    pending = set(futures)
+    while pending:
+        # Models which finished while the caller was busy are returned straight away
+        done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            try:
+                yield futures[future], future.result(), None
+            except Exception as error:
+                yield futures[future], None, error
+    for future in pending:
+        future.cancel()
+        yield futures[future], None, TimeoutError(futures[future] + " did not respond within " + str(timeout) + " seconds.")
+
+def run_request(question_to_ask, model_type, timeout=None, use_cache=True):
+    # Identical prompts to the same model are answered from the response cache, pass use_cache=False to
+    # ask the model again, its new answer then replaces the cached one
+    if use_cache:
+        with span("response_cache", model=model_type) as attributes:
+            cached = response_cache.get(question_to_ask, model_type)
+            attributes["hit"] = cached is not None
+        if cached is not None:
+            return cached
+    # The same prompt sent by several sessions at once is asked once, the others wait for that answer
+    return single_flight.do(("run_request", response_cache.make_key(question_to_ask, model_type)),
+                            lambda: _ask_model(question_to_ask, model_type, timeout, use_cache))
+
+def _ask_model(question_to_ask, model_type, timeout, use_cache):
     if model_type == "gpt-4" or model_type == "gpt-3.5-turbo" :
         # Run OpenAI ChatCompletion API
         task = "Generate Python Code Script."
         if model_type == "gpt-4":
             # Ensure GPT-4 does not include additional comments
             task = task + " The script should only include code, no comments."
-        # Load API Key
-        sys.path.append('../..')
-        _ = load_dotenv(find_dotenv())  # read local .env file
-        openai.api_key = os.environ['OPENAI_API_KEY']
-        client = OpenAI()
-        response = client.chat.completions.create(model=model_type,
-            messages=[{"role":"system","content":task},{"role":"user","content":question_to_ask}])
+        # Use the shared client so the connection to OpenAI is kept alive between requests
+        client = get_client()
+        # Wait for the model's quota, shared with every other session, and retry if OpenAI pushes back
+        with span("llm", model=model_type):
+            response = scheduler.call(lambda: client.chat.completions.create(model=model_type,
+                messages=[{"role":"system","content":task},{"role":"user","content":question_to_ask}], timeout=timeout),
+                model_type, estimate_tokens(task + question_to_ask) + COMPLETION_ESTIMATE,
+                usage=lambda r: r.usage.total_tokens if r.usage else 0)
         response = json.loads(response.model_dump_json())
+        if response.get("usage"):
+            record_tokens(model_type, response["usage"]["prompt_tokens"], response["usage"]["completion_tokens"])
         llm_response = response["choices"][0]["message"]["content"]
     # rejig the response
     llm_response = format_response(llm_response)
+    response_cache.put(question_to_ask, model_type, llm_response)
     return llm_response
 
 def format_response( res):
@@ -69,26 +115,215 @@ def format_question(primer_desc,primer_code , question, model_type):
     # Put the question at the end of the description primer within quotes, then add on the code primer.
     return  '"""\n' + primer_desc + question + '\n"""\n' + primer_code
 
-def get_primer(df_dataset,df_name):
+# Cache of dataset profiles keyed on the dataset fingerprint, oldest entries are dropped first
+PROFILE_CACHE_SIZE = 64
+_profile_cache = OrderedDict()
+# Fingerprints of dataframes already hashed, keyed on id() and checked with a weak reference
+_fingerprint_cache = {}
+_profile_lock = threading.Lock()
+
+def dataset_fingerprint(df_dataset):
+    # Hash the column names, dtypes and contents of a dataframe so identical data gets the same key.
+    # The hash is remembered for the lifetime of the dataframe so repeated calls are free.
+    key = id(df_dataset)
+    with _profile_lock:
+        cached = _fingerprint_cache.get(key)
+    if cached is not None and cached[0]() is df_dataset and cached[1] == df_dataset.shape:
+        return cached[2]
+    digest = hashlib.sha1()
+    digest.update("\x1f".join(str(x) + ":" + str(t) for x, t in df_dataset.dtypes.items()).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df_dataset, index=False).values.tobytes())
+    fingerprint = digest.hexdigest()
+    with _profile_lock:
+        # Forget dataframes which have been garbage collected
+        for stale in [k for k, v in _fingerprint_cache.items() if v[0]() is None]:
+            del _fingerprint_cache[stale]
+        _fingerprint_cache[key] = (weakref.ref(df_dataset), df_dataset.shape, fingerprint)
+    return fingerprint
+
+def profile_dataset(df_dataset):
+    # Describe each column of a dataframe for the primer: its dtype class, its cardinality
+    # and, for categorical columns with less than 20 unique values, the values themselves.
+    # Returns a list of dicts, cached per dataset fingerprint.
+    fingerprint = dataset_fingerprint(df_dataset)
+    with _profile_lock:
+        if fingerprint in _profile_cache:
+            _profile_cache.move_to_end(fingerprint)
+            return _profile_cache[fingerprint]
+    # One vectorized pass for the number of distinct values (NaN counts as a value, like drop_duplicates)
+    cardinality = df_dataset.nunique(dropna=False)
+    profile = []
+    for position, (column, dtype) in enumerate(df_dataset.dtypes.items()):
+        if pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype) \
+                or isinstance(dtype, pd.CategoricalDtype):
+            kind = "categorical"
+        elif pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_float_dtype(dtype):
+            kind = "numeric"
+        else:
+            kind = "other"
+        values = None
+        if kind == "categorical" and cardinality.iloc[position] < 20:
+            values = [str(x) for x in df_dataset.iloc[:, position].unique()]
+        # Datasets are stored compacted (int16, float32 ...) but scripts get the dtypes read_csv gives
+        if pd.api.types.is_integer_dtype(dtype):
+            dtype = "int64"
+        elif pd.api.types.is_float_dtype(dtype):
+            dtype = "float64"
+        profile.append({"name": str(column), "kind": kind, "dtype": str(dtype),
+                        "cardinality": int(cardinality.iloc[position]), "values": values})
+    with _profile_lock:
+        _profile_cache[fingerprint] = profile
+        while len(_profile_cache) > PROFILE_CACHE_SIZE:
+            _profile_cache.popitem(last=False)
+    return profile
+
+def clear_profile_cache():
+    # Forget every cached fingerprint and profile, e.g. to time a cold get_primer
+    with _profile_lock:
+        _profile_cache.clear()
+        _fingerprint_cache.clear()
+
+# How much of the dataset each model is told about: the token budget of the whole prompt (primer,
+# question and code) and the number of categorical values listed per column.  Models which follow
+# long prompts well get more detail.  PRIMER_TOKENS overrides the budgets of every model, a budget
+# passed to get_primer overrides both.
+PRIMER_DETAIL = {
+    "gpt-4": {"budget": 2000, "values": 19},
+    "gpt-3.5-turbo": {"budget": 1000, "values": 8},
+}
+DEFAULT_PRIMER_DETAIL = {"budget": 1000, "values": 8}
+PRIMER_TOKENS = int(os.environ.get("PRIMER_TOKENS", "0"))
+# Longer categorical values are cut short in the primer
+MAX_VALUE_CHARS = 40
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+def count_tokens(text, model_type="gpt-4"):
+    # Number of tokens text takes for the model, counted with tiktoken when it is installed and its
+    # encoding can be loaded, otherwise estimated from the length of the text
+    with _encodings_lock:
+        if model_type not in _encodings:
+            try:
+                import tiktoken
+                _encodings[model_type] = tiktoken.encoding_for_model(model_type)
+            except Exception:
+                # Unknown model, or the encoding could not be downloaded.  Not tried again.
+                _encodings[model_type] = None
+        encoding = _encodings[model_type]
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def _words(text):
+    return set(re.findall(r"[a-z0-9]+", text.lower()))
+
+def rank_columns(profile, question):
+    # Columns ordered by how closely the question refers to them: by the full name, by a word of
+    # the name or by one of its values.  Columns the question does not mention keep their order.
+    question_lower = question.lower()
+    question_words = _words(question)
+    # Words which only differ in their ending still match, e.g. "prices" and "price"
+    question_stems = {word[:5] for word in question_words if len(word) > 3}
+    scores = []
+    for position, column in enumerate(profile):
+        name = column["name"].lower()
+        score = 0
+        if name and name in question_lower:
+            score += 10
+        for word in _words(name):
+            if word in question_words:
+                score += 3
+            elif len(word) > 3 and word[:5] in question_stems:
+                score += 2
+        for value in column["values"] or []:
+            if len(value) > 2 and value.lower() in question_lower:
+                score += 5
+                break
+        scores.append((-score, position))
+    return [profile[position] for _, position in sorted(scores)]
+
+def _column_line(column, values_limit=None, question_lower="", max_chars=None):
+    # The sentence describing one column, or None for columns which are not described.
+    # values_limit and max_chars shorten the list of categorical values, values in the question first.
+    if column["values"] is not None:
+        values = column["values"]
+        if values_limit is not None and len(values) > values_limit:
+            values = sorted(values, key=lambda value: value.lower() not in question_lower)[:values_limit]
+        if max_chars is not None:
+            values = [value if len(value) <= max_chars else value[:max_chars] + "..." for value in values]
+        line = "\nThe column '" + column["name"] + "' has categorical values '" + "','".join(values) + "'"
+        if len(values) < len(column["values"]):
+            line = line + " and " + str(len(column["values"]) - len(values)) + " more"
+        return line + ". "
+    if column["kind"] == "numeric":
+        return "\nThe column '" + column["name"] + "' is type " + column["dtype"] + " and contains numeric values. "
+    return None
+
+def get_primer(df_dataset,df_name, profile=None, question=None, model_type=None, budget=None):
     # Primer function to take a dataframe and its name
     # and the name of the columns
     # and any columns with less than 20 unique values it adds the values to the primer
     # and horizontal grid lines and labeling
-    primer_desc = "Use a dataframe called df from data_file.csv with columns '" \
-        + "','".join(str(x) for x in df_dataset.columns) + "'. "
-    for i in df_dataset.columns:
-        if len(df_dataset[i].drop_duplicates()) < 20 and df_dataset.dtypes[i]=="O":
-            primer_desc = primer_desc + "\nThe column '" + i + "' has categorical values '" + \
-                "','".join(str(x) for x in df_dataset[i].drop_duplicates()) + "'. "
-        elif df_dataset.dtypes[i]=="int64" or df_dataset.dtypes[i]=="float64":
-            primer_desc = primer_desc + "\nThe column '" + i + "' is type " + str(df_dataset.dtypes[i]) + " and contains numeric values. "
-    primer_desc = primer_desc + "\nLabel the x and y axes appropriately."
-    primer_desc = primer_desc + "\nAdd a title. Set the fig suptitle as empty."
-    primer_desc = primer_desc + "{}" # Space for additional instructions if needed
-    primer_desc = primer_desc + "\nUsing Python version 3.9.12, create a script using the dataframe df to graph the following: "
+    # A profile computed elsewhere (e.g. while streaming a large upload) can be passed in
+    # Given the model (and the question), the primer is fitted into the model's token budget.  The full
+    # primer is used whenever it fits; only a prompt over budget has its value lists shortened to the
+    # model's detail level, and when the columns still do not fit, those the question refers to are
+    # described first and the rest are left out.
+    if profile is None:
+        with span("profile"):
+            profile = profile_dataset(df_dataset)
     pimer_code = "import pandas as pd\nimport matplotlib.pyplot as plt\n"
     pimer_code = pimer_code + "fig,ax = plt.subplots(1,1,figsize=(10,4))\n"
     pimer_code = pimer_code + "ax.spines['top'].set_visible(False)\nax.spines['right'].set_visible(False) \n"
     pimer_code = pimer_code + "df=" + df_name + ".copy()\n"
-    return primer_desc,pimer_code
+    instructions = ["\nLabel the x and y axes appropriately.", "\nAdd a title. Set the fig suptitle as empty.",
+                    "{}", # Space for additional instructions if needed
+                    "\nUsing Python version 3.9.12, create a script using the dataframe df to graph the following: "]
+
+    # Everything about every column, as the primer has always been
+    names = [column["name"] for column in profile]
+    lines = [line for line in (_column_line(column) for column in profile) if line is not None]
+    if model_type is not None or budget is not None:
+        detail = PRIMER_DETAIL.get(model_type, DEFAULT_PRIMER_DETAIL)
+        budget = budget or PRIMER_TOKENS or detail["budget"]
+        model_type = model_type or "gpt-4"
+        question = question or ""
+        full = _primer_desc(names, lines, len(profile), instructions)
+        if count_tokens(full + question + pimer_code, model_type) + 20 <= budget:
+            return full, pimer_code
+        ranked = rank_columns(profile, question)
+        # What is left for the columns once the instructions, the question and the code are counted
+        left = budget - count_tokens("".join(instructions) + question + pimer_code, model_type) - 20
+        # The list of names takes at most half of it, the most relevant names are kept
+        kept = []
+        for column in ranked:
+            cost = count_tokens(column["name"], model_type) + 1
+            if cost > left / 2:
+                break
+            left -= cost
+            kept.append(column)
+        # Then as many columns as fit are described, the most relevant first
+        described = {}
+        for column in kept:
+            line = _column_line(column, detail["values"], question.lower(), MAX_VALUE_CHARS)
+            if line is None:
+                continue
+            cost = count_tokens(line, model_type)
+            if cost <= left:
+                left -= cost
+                described[column["name"]] = line
+        # Back in the order of the dataset
+        kept_names = set(column["name"] for column in kept)
+        names = [column["name"] for column in profile if column["name"] in kept_names]
+        lines = [described[column["name"]] for column in profile if column["name"] in described]
+
+    return _primer_desc(names, lines, len(profile), instructions),pimer_code
 
+def _primer_desc(names, lines, column_count, instructions):
+    primer_desc = ["Use a dataframe called df from data_file.csv with columns '" + "','".join(names) + "'. "]
+    if len(names) < column_count:
+        primer_desc.append("It has " + str(column_count - len(names)) + " more columns which are not relevant. ")
+    primer_desc.extend(lines)
+    primer_desc.extend(instructions)
+    return "".join(primer_desc)
@@ -0,0 +1,376 @@
+import hashlib
+import importlib.util
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+from large_ingest import ingest_csv
+
+# Datasets bundled with the app, in the order they are offered
+BUILTIN_DATASETS = {
+    "Movies": "movies.csv",
+    "Housing": "housing.csv",
+    "Cars": "cars.csv",
+    "Colleges": "colleges.csv",
+    "Customers & Products": "customers_and_products_contacts.csv",
+    "Department Store": "department_store.csv",
+    "Energy Production": "energy_production.csv",
+}
+
+# Parsed datasets are stored here in a columnar format so they are never parsed from CSV twice
+CACHE_DIR = os.environ.get("DATASET_CACHE_DIR", os.path.join(".cache", "datasets"))
+
+# Memory allowed for uploaded datasets, per session and for the whole process, in MB
+SESSION_BUDGET_MB = float(os.environ.get("DATASET_SESSION_BUDGET_MB", "200"))
+GLOBAL_BUDGET_MB = float(os.environ.get("DATASET_GLOBAL_BUDGET_MB", "2000"))
+
+# Uploads bigger than this are read in chunks, only a sample of them is kept in memory
+LARGE_UPLOAD_MB = float(os.environ.get("LARGE_UPLOAD_MB", "50"))
+
+# Cache files of uploads which have not been in memory for this long are deleted
+UPLOAD_CACHE_HOURS = float(os.environ.get("UPLOAD_CACHE_HOURS", "24"))
+
+# Text columns with at most this share of distinct values are stored as categoricals
+CATEGORY_RATIO = 0.5
+
+# Without pyarrow fall back to pickles, still much faster to load than CSV.
+# Only looked up here, pyarrow is imported by pandas when the first Parquet file is read.
+CACHE_FORMAT = "parquet" if importlib.util.find_spec("pyarrow") is not None else "pickle"
+
+
+def compact_dataset(df):
+    # Shrink a freshly parsed dataframe for storage: repeated text values (Genre, Origin, Region ...)
+    # become categoricals and numbers are downcast to the smallest dtype which holds them exactly.
+    # Scripts never see this copy, they get restore_dtypes() of it.
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_object_dtype(values.dtype) or pd.api.types.is_string_dtype(values.dtype):
+            if len(values) > 0 and values.nunique(dropna=False) <= CATEGORY_RATIO * len(values):
+                df[column] = values.astype("category")
+        elif pd.api.types.is_integer_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+            df[column] = pd.to_numeric(values, downcast="integer")
+        elif pd.api.types.is_float_dtype(values.dtype):
+            # Only narrowed when every value survives the round trip, prices like 7.1 stay float64
+            narrowed = values.astype("float32")
+            if np.array_equal(narrowed.to_numpy("float64"), values.to_numpy("float64"), equal_nan=True):
+                df[column] = narrowed
+    return df
+
+
+def restore_dtypes(df):
+    # The dataframe as read_csv parsed it, before compact_dataset: the generated scripts run on this so
+    # their arithmetic does not overflow a narrow integer and text columns behave as strings.
+    # Every value survives compacting exactly, so the round trip gives back the same numbers.
+    restored = {}
+    for column, dtype in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            restored[column] = dtype.categories.dtype
+        elif pd.api.types.is_integer_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) and dtype != "int64":
+            restored[column] = "int64"
+        elif dtype == "float32":
+            restored[column] = "float64"
+    if not restored:
+        return df
+    return df.astype(restored)
+
+
+def dataset_size(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def upload_key(data):
+    # Uploads are keyed on their content so identical files share one copy
+    return "upload:" + hashlib.sha256(data).hexdigest()
+
+
+class DatasetRegistry:
+    # Process wide store of parsed datasets shared by every session.
+    # Datasets are loaded the first time they are used, from the columnar cache if it is
+    # up to date and from the CSV otherwise, and then kept in memory.  When uploads (or the samples
+    # of large uploads) take more than budget_mb the least recently used ones are dropped from memory,
+    # they stay in the on disk cache and are loaded again if a session asks for them.  Cache files of
+    # uploads which have been out of memory for longer than max_age_hours are deleted.
+
+    def __init__(self, cache_dir=CACHE_DIR, budget_mb=GLOBAL_BUDGET_MB, max_age_hours=UPLOAD_CACHE_HOURS):
+        self.cache_dir = cache_dir
+        self.budget = budget_mb * 1024 * 1024
+        self.max_age = max_age_hours * 3600
+        self._frames = {}
+        self._sizes = {}
+        self._upload_order = OrderedDict()
+        self._large = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _touch(self, key):
+        # Called with the lock held, mark an upload as just used
+        if key in self._upload_order:
+            self._upload_order.move_to_end(key)
+
+    def _enforce_budget(self, keep):
+        # Called with the lock held, drop the least recently used uploads until they fit the budget
+        in_memory = sum(self._sizes[key] for key in self._upload_order)
+        for key in list(self._upload_order):
+            if in_memory <= self.budget:
+                break
+            if key == keep:
+                continue
+            in_memory -= self._sizes[key]
+            del self._upload_order[key]
+            del self._frames[key]
+            # The cache files expire max_age after the upload left memory
+            for path in (self._cache_path(key), self._sample_path(key)):
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+
+    def size_of(self, key):
+        # Bytes used in memory by a dataset, 0 if it has never been loaded
+        with self._lock:
+            return self._sizes.get(key, 0)
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _cache_path(self, key):
+        name = key.replace(":", "_").replace(" ", "_").replace("&", "and")
+        return os.path.join(self.cache_dir, name + "." + CACHE_FORMAT)
+
+    def _sample_path(self, key):
+        # The sample of a large upload, read back when it has been dropped from memory
+        return self._cache_path(key + ":sample")
+
+    def remove_expired(self):
+        # Delete the cache files of uploads which have been out of memory for longer than max_age
+        if not os.path.isdir(self.cache_dir):
+            return
+        expired = time.time() - self.max_age
+        for name in os.listdir(self.cache_dir):
+            if not name.startswith("upload_"):
+                continue
+            key = "upload:" + name.split(".")[0][len("upload_"):].replace("_sample", "")
+            path = os.path.join(self.cache_dir, name)
+            with self._lock:
+                if key in self._frames:
+                    continue
+                try:
+                    if os.path.getmtime(path) >= expired:
+                        continue
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._large.pop(key, None)
+
+    def _read_cache(self, path):
+        if CACHE_FORMAT == "parquet":
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+
+    def _write_cache(self, df, path):
+        # Write to a temporary file first so other processes never see half a file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = path + ".tmp" + str(threading.get_ident())
+        try:
+            if CACHE_FORMAT == "parquet":
+                df.to_parquet(temp_path, index=False)
+            else:
+                df.to_pickle(temp_path)
+            os.replace(temp_path, path)
+        except Exception as e:
+            # The cache is only a speed up, carry on with the parsed frame
+            print("Dataset cache write failed.\n" + str(e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _load(self, key, parse, source_mtime=None, path=None):
+        with self._lock:
+            if key in self._frames:
+                self._touch(key)
+                return self._frames[key]
+        # Only one session parses a given dataset, the others wait for it
+        with self._key_lock(key):
+            with self._lock:
+                if key in self._frames:
+                    self._touch(key)
+                    return self._frames[key]
+            path = path or self._cache_path(key)
+            df = None
+            if os.path.exists(path) and (source_mtime is None or os.path.getmtime(path) >= source_mtime):
+                try:
+                    df = self._read_cache(path)
+                except Exception as e:
+                    print("Dataset cache read failed.\n" + str(e))
+            if df is None:
+                if parse is None:
+                    raise KeyError(key)
+                df = compact_dataset(parse())
+                self._write_cache(df, path)
+            with self._lock:
+                self._frames[key] = df
+                self._sizes[key] = dataset_size(df)
+                if not key.startswith("builtin:"):
+                    self._upload_order[key] = None
+                    self._enforce_budget(keep=key)
+            return df
+
+    def get(self, key):
+        # Return the dataset stored under key, loading it if needed
+        if key.startswith("builtin:"):
+            file_name = BUILTIN_DATASETS[key[len("builtin:"):]]
+            return self._load(key, lambda: pd.read_csv(file_name), os.path.getmtime(file_name))
+        with self._lock:
+            if key in self._frames:
+                self._touch(key)
+                return self._frames[key]
+            large = key in self._large
+        # Uploads which have left memory can still be in the on disk cache, for large uploads the sample
+        path = self._sample_path(key) if large else self._cache_path(key)
+        if os.path.exists(path):
+            return self._load(key, None, path=path)
+        raise KeyError(key)
+
+    def has(self, key):
+        # Whether get(key) can still return the dataset, uploads expire from the on disk cache
+        if key.startswith("builtin:"):
+            return True
+        with self._lock:
+            if key in self._frames:
+                return True
+            large = key in self._large
+        return os.path.exists(self._sample_path(key) if large else self._cache_path(key))
+
+    def add_upload(self, data):
+        # Parse an uploaded CSV (bytes) unless the same content is already known, and return its key
+        self.remove_expired()
+        key = upload_key(data)
+        if len(data) > LARGE_UPLOAD_MB * 1024 * 1024 and CACHE_FORMAT == "parquet":
+            self._load_large(key, data)
+        else:
+            self._load(key, lambda: pd.read_csv(io.BytesIO(data)))
+        return key
+
+    def _load_large(self, key, data):
+        # Stream a large upload to the on disk cache, where the plotting workers read all of it,
+        # and keep only a sample and the profile of every row in memory
+        with self._key_lock(key):
+            with self._lock:
+                if key in self._large and os.path.exists(self._cache_path(key)):
+                    return
+            path = self._cache_path(key)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = path + ".tmp" + str(threading.get_ident())
+            try:
+                sample, profile, rows = ingest_csv(io.BytesIO(data), temp_path, seed=int(key[-8:], 16))
+                os.replace(temp_path, path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            sample = compact_dataset(sample)
+            self._write_cache(sample, self._sample_path(key))
+            with self._lock:
+                # The sample counts against the budget like any upload, the profile is small and stays
+                self._large[key] = {"profile": profile, "rows": rows}
+                self._frames[key] = sample
+                self._sizes[key] = dataset_size(sample)
+                self._upload_order[key] = None
+                self._enforce_budget(keep=key)
+
+    def is_large(self, key):
+        with self._lock:
+            return key in self._large
+
+    def profile_of(self, key):
+        # Profile of every row of a large upload, None for datasets which are fully in memory
+        with self._lock:
+            return self._large[key]["profile"] if key in self._large else None
+
+    def rows_of(self, key):
+        with self._lock:
+            if key in self._large:
+                return self._large[key]["rows"]
+        return len(self.get(key))
+
+    def preview(self, key, start, rows):
+        # Rows start to start + rows of a dataset, large uploads are read from disk a row group at a time
+        if not self.is_large(key):
+            return self.get(key).iloc[start:start + rows]
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(self._cache_path(key))
+        pieces = []
+        first_row = 0
+        for group in range(parquet_file.num_row_groups):
+            group_rows = parquet_file.metadata.row_group(group).num_rows
+            if first_row + group_rows > start and first_row < start + rows:
+                table = parquet_file.read_row_group(group)
+                offset = max(0, start - first_row)
+                pieces.append(table.slice(offset, start + rows - first_row - offset).to_pandas())
+            first_row += group_rows
+            if first_row >= start + rows:
+                break
+        if not pieces:
+            return self.get(key).iloc[0:0]
+        return pd.concat(pieces, ignore_index=True)
+
+
+class SessionDatasets(Mapping):
+    # The datasets one session can choose from: display name -> registry key.
+    # Behaves like a dict of dataframes, so the generated scripts can keep using datasets["Movies"],
+    # but a dataset is only loaded when it is looked up.  Uploads beyond budget_mb are
+    # removed from the session, least recently used first.
+
+    def __init__(self, registry, budget_mb=SESSION_BUDGET_MB):
+        self.registry = registry
+        self.budget = budget_mb * 1024 * 1024
+        self.keys_by_name = {name: "builtin:" + name for name in BUILTIN_DATASETS}
+        self.upload_order = OrderedDict()
+
+    def add(self, name, key):
+        # Add an upload and return the name it is listed under.  Uploads never replace a built-in
+        # dataset, one called like a built-in one is listed as e.g. "Movies (upload)".
+        if name in BUILTIN_DATASETS:
+            name = name + " (upload)"
+        self.keys_by_name[name] = key
+        self.upload_order[name] = None
+        self.upload_order.move_to_end(name)
+        # Forget the oldest uploads until this session fits its budget
+        total = sum(self.registry.size_of(self.keys_by_name[upload]) for upload in self.upload_order)
+        for upload in list(self.upload_order):
+            if total <= self.budget:
+                break
+            if upload == name:
+                continue
+            total -= self.registry.size_of(self.keys_by_name[upload])
+            del self.upload_order[upload]
+            del self.keys_by_name[upload]
+        return name
+
+    def remove_missing(self):
+        # Forget the uploads whose data has expired from the registry and return their names
+        missing = [name for name in self.upload_order if not self.registry.has(self.keys_by_name[name])]
+        for name in missing:
+            del self.upload_order[name]
+            del self.keys_by_name[name]
+        return missing
+
+    def __getitem__(self, name):
+        if name in self.upload_order:
+            self.upload_order.move_to_end(name)
+        return self.registry.get(self.keys_by_name[name])
+
+    def __iter__(self):
+        return iter(self.keys_by_name)
+
+    def __len__(self):
+        return len(self.keys_by_name)
+
+
+# Registry shared by every session in the process
+registry = DatasetRegistry()
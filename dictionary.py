@@ -0,0 +1,199 @@
+import csv
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+# Where the dictionary index lives and the word list it is filled from, can be set from the environment
+DICTIONARY_PATH = os.environ.get("DICTIONARY_PATH", os.path.join(".cache", "dictionary.sqlite"))
+WORD_LIST = os.environ.get("DICTIONARY_WORD_LIST", "dictionary_words.csv")
+
+# Inflected ending -> ending of the dictionary form, tried in order when the word itself is not indexed.
+# Each group of rules belongs to one paradigm and only leads to a bundled entry of that paradigm,
+# recognised by the pattern its entry matches, so "libra" is not taken for a form of the noun "libro".
+LEMMA_RULES = {
+    "Latin": [
+        # first declension nouns: via, viae (f.)
+        (r"^\w+, \w+ae \(f\.\)", [("arum", "a"), ("ae", "a"), ("am", "a"), ("as", "a"), ("is", "a")]),
+        # second declension nouns: dominus, domini (m.) and bellum, belli (n.)
+        (r"^\w+us, \w+i \(m\.\)", [("orum", "us"), ("um", "us"), ("os", "us"), ("i", "us"), ("o", "us"),
+                                  ("is", "us"), ("e", "us")]),
+        (r"^\w+um, \w+i \(n\.\)", [("orum", "um"), ("a", "um"), ("i", "um"), ("o", "um"), ("is", "um")]),
+        # present tense verbs, first to fourth conjugation: amo, amare / habeo, habere / duco, ducere / audio, audire
+        (r"^\w+o, \w+are,", [("amus", "o"), ("atis", "o"), ("ant", "o"), ("are", "o"), ("at", "o"), ("as", "o")]),
+        (r"^\w+eo, \w+ere,", [("emus", "eo"), ("etis", "eo"), ("ent", "eo"), ("ere", "eo"), ("et", "eo"),
+                              ("es", "eo")]),
+        (r"^\w+[^ei]o, \w+ere,", [("imus", "o"), ("itis", "o"), ("unt", "o"), ("ere", "o"), ("it", "o"),
+                                  ("is", "o")]),
+        (r"^\w+io, \w+ire,", [("iunt", "io"), ("ire", "io"), ("it", "io"), ("is", "io")]),
+    ],
+    "Spanish": [
+        # plurals of nouns and adjectives: luz, luces / ciudad, ciudades / casa, casas
+        (r"\((m|f|adj)\.", [("ces", "z"), ("es", ""), ("s", "")]),
+        # feminine and plural of adjectives: bueno, buena, buenos
+        (r"\(adj\.", [("as", "o"), ("os", "o"), ("a", "o")]),
+        # present tense verbs: hablar, comer, vivir
+        (r"\(v\.", [("amos", "ar"), ("an", "ar"), ("as", "ar"), ("a", "ar"), ("o", "ar"),
+                     ("emos", "er"), ("en", "er"), ("es", "er"), ("e", "er"), ("o", "er"),
+                     ("imos", "ir"), ("en", "ir"), ("es", "ir"), ("e", "ir"), ("o", "ir")]),
+    ],
+}
+# Stems shorter than this are not tried, so "es" does not turn into ""
+MIN_STEM = 2
+# Bumped whenever the keys the word list is indexed under change, so an existing index is rebuilt
+INDEX_VERSION = "2"
+
+
+def normalize(language, text):
+    # The form words are indexed under: lower case, no accents (but Spanish keeps ñ), no punctuation.
+    # Latin also folds j into i and v into u.  Mandarin keeps its tone marks, which tell words like
+    # "mā" (mother) and "mǎ" (horse) apart, and drops spaces so pinyin like "ni hao" matches "nihao".
+    text = unicodedata.normalize("NFC", text.strip().lower())
+    folded = []
+    for char in text:
+        if language == "Mandarin" or (char == "ñ" and language == "Spanish"):
+            folded.append(char)
+            continue
+        folded.extend(c for c in unicodedata.normalize("NFKD", char) if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", unicodedata.normalize("NFC", "".join(folded)))
+    text = re.sub(r"\s+", " ", text).strip()
+    if language == "Latin":
+        text = text.replace("j", "i").replace("v", "u")
+    elif language == "Mandarin":
+        text = text.replace(" ", "")
+    return text
+
+
+def without_tones(text):
+    # Pinyin without its tone marks, "nǐhǎo" -> "nihao"
+    return unicodedata.normalize("NFC", "".join(c for c in unicodedata.normalize("NFKD", text)
+                                               if not unicodedata.combining(c)))
+
+
+def bundled_keys(language, word, aliases, entry):
+    # The keys a bundled entry is indexed under: the word and its aliases, and for Mandarin also the
+    # pinyin given in the entry, "你好 (nǐ hǎo) — hello", both with and without tone marks
+    forms = [word] + aliases
+    if language == "Mandarin":
+        forms.extend(re.findall(r"\(([^)]*)\)", entry)[:1])
+    keys = []
+    for form in forms:
+        key = normalize(language, form)
+        for candidate in (key, without_tones(key) if language == "Mandarin" else key):
+            if candidate and candidate not in keys:
+                keys.append(candidate)
+    return keys
+
+
+def lemma_candidates(language, word):
+    # The normalized word, then (dictionary form, paradigm pattern) for every form it may be an inflection of
+    key = normalize(language, word)
+    candidates = []
+    if " " not in key:
+        for paradigm, rules in LEMMA_RULES.get(language, []):
+            for ending, lemma_ending in rules:
+                if key.endswith(ending) and len(key) - len(ending) >= MIN_STEM:
+                    candidate = key[:len(key) - len(ending)] + lemma_ending
+                    if candidate != key and (candidate, paradigm) not in candidates:
+                        candidates.append((candidate, paradigm))
+    return key, candidates
+
+
+class Dictionary:
+    # SQLite index of dictionary entries per language, in front of the LLM for "qs <word>" lookups.
+    # Filled from the bundled word list (reloaded when the file changes) and from LLM answers
+    # which passed moderation.  Entries from the word list win over LLM answers.
+
+    def __init__(self, path=DICTIONARY_PATH, word_list=WORD_LIST):
+        self.path = path
+        self.word_list = word_list
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS entries (language TEXT, key TEXT, word TEXT, entry TEXT, "
+                               "source TEXT, created REAL, PRIMARY KEY (language, key))")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            self._load_word_list()
+        return self._conn
+
+    def _load_word_list(self):
+        # (Re)index the bundled words when the word list is newer than what was indexed
+        if not os.path.exists(self.word_list):
+            return
+        mtime = str(os.path.getmtime(self.word_list)) + "/" + INDEX_VERSION
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'word_list'").fetchone()
+        if row is not None and row[0] == mtime:
+            return
+        now = time.time()
+        with open(self.word_list, encoding="utf-8", newline="") as f:
+            rows = []
+            for record in csv.DictReader(f):
+                aliases = [alias for alias in record["aliases"].split("|") if alias]
+                for key in bundled_keys(record["language"], record["word"], aliases, record["entry"]):
+                    rows.append((record["language"], key, record["word"], record["entry"], "bundled", now))
+        self._conn.execute("DELETE FROM entries WHERE source = 'bundled'")
+        # The first form listed keeps a key shared by several words, LLM answers under it are replaced
+        for language, key, word, entry, source, created in rows:
+            self._conn.execute("DELETE FROM entries WHERE language = ? AND key = ? AND source != 'bundled'",
+                               (language, key))
+            self._conn.execute("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                               (language, key, word, entry, source, created))
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('word_list', ?)", (mtime,))
+        self._conn.commit()
+
+    def lookup(self, language, word):
+        # The entry for word, or for the bundled dictionary form it is an inflection of, or None.
+        # An inflection is answered with "<word> — form of <dictionary form>" above the entry.
+        key, candidates = lemma_candidates(language, word)
+        if not key:
+            return None
+        keys = [key] + [candidate for candidate, _ in candidates]
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT key, word, entry, source FROM entries WHERE language = ? AND key IN (%s)"
+                % ",".join("?" * len(keys)), [language] + keys).fetchall()
+            found = {row[0]: row[1:] for row in rows}
+            # The word itself first, then the rules in order, each only for a bundled entry of its paradigm
+            entry = found[key][1] if key in found else None
+            for candidate, paradigm in candidates:
+                if entry is not None:
+                    break
+                if candidate in found:
+                    lemma, lemma_entry, source = found[candidate]
+                    if source == "bundled" and re.search(paradigm, lemma_entry):
+                        entry = word.strip() + " — form of " + lemma + "\n\n" + lemma_entry
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def add(self, language, word, entry):
+        # Remember an LLM answer for word, bundled entries are never replaced
+        key = normalize(language, word)
+        if not key or not entry.strip():
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, 'llm', ?)",
+                         (language, key, word.strip(), entry, time.time()))
+            conn.commit()
+
+    def stats(self):
+        with self._lock:
+            size = self._connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "size": size}
+
+
+# Dictionary shared by every session in the process
+dictionary = Dictionary()
@@ -0,0 +1,304 @@
+import os
+
+import numpy as np
+
+# Most points, markers and categories a plotting call draws, can be set from the environment.
+# Calls with more are thinned out or aggregated before they reach matplotlib, so rendering time and
+# image size stay bounded whatever the size of the dataset.
+MAX_LINE_POINTS = int(os.environ.get("PLOT_MAX_LINE_POINTS", "5000"))
+MAX_SCATTER_POINTS = int(os.environ.get("PLOT_MAX_SCATTER_POINTS", "20000"))
+MAX_CATEGORIES = int(os.environ.get("PLOT_MAX_CATEGORIES", "50"))
+DOWNSAMPLING_DISABLED = os.environ.get("PLOT_DOWNSAMPLING_DISABLED", "") not in ("", "0", "false", "False")
+
+_installed = False
+
+
+def lttb(x, y, threshold):
+    # Indices of threshold points which keep the visual shape of the line through (x, y):
+    # Largest-Triangle-Three-Buckets, x sorted, both float arrays without NaN
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    # threshold - 2 buckets between the first and the last point, which are always kept
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        # The point of this bucket forming the largest triangle with the previous point and the
+        # average of the next bucket
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        area = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                      - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        keep[i + 1] = previous
+    return keep
+
+
+def stride(n, threshold):
+    # Indices of threshold evenly spaced points, the first and the last included
+    if threshold >= n:
+        return np.arange(n)
+    return np.unique(np.linspace(0, n - 1, threshold).astype(np.int64))
+
+
+def sample(n, threshold):
+    # Indices of a random (but repeatable) sample of threshold points, in their original order
+    if threshold >= n:
+        return np.arange(n)
+    return np.sort(np.random.default_rng(0).choice(n, threshold, replace=False))
+
+
+def top_categories(values, threshold):
+    # Indices of the threshold largest values, in their original order
+    values = np.nan_to_num(np.abs(np.asarray(values, dtype=float)), nan=-1.0)
+    if threshold >= len(values):
+        return np.arange(len(values))
+    return np.sort(np.argsort(-values, kind="stable")[:threshold])
+
+
+def _length(value):
+    if value is None or isinstance(value, (str, bytes)):
+        return None
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+def _take(value, index, n):
+    # value at index if it holds one entry per point, otherwise value itself
+    if _length(value) != n:
+        return value
+    if hasattr(value, "iloc"):
+        return value.iloc[index]
+    if isinstance(value, np.ndarray):
+        return value[index]
+    return np.asarray(value)[index]
+
+
+def _as_float(values):
+    # values as a float array (dates as nanoseconds), or None when they are not numbers
+    values = np.ma.filled(np.ma.asarray(values), np.nan) if np.ma.isMaskedArray(values) else np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64) or np.issubdtype(values.dtype, np.timedelta64):
+        return values.astype("int64").astype(float)
+    if not np.issubdtype(values.dtype, np.number) or np.issubdtype(values.dtype, np.complexfloating):
+        return None
+    return values.astype(float)
+
+
+def _is_text(values):
+    values = np.asarray(values)
+    return values.dtype.kind in "OUS" and len(values) > 0 and isinstance(values.flat[0], str)
+
+
+def line_points(x, y, threshold=MAX_LINE_POINTS):
+    # Indices of the points to draw of a line: LTTB for a series over sorted numbers or dates,
+    # evenly spaced points otherwise
+    n = len(y)
+    if n <= threshold:
+        return None
+    xf, yf = _as_float(x), _as_float(y)
+    if (xf is None or yf is None or yf.ndim != 1 or np.isnan(xf).any() or np.isnan(yf).any()
+            or (np.diff(xf) < 0).any()):
+        return stride(n, threshold)
+    return lttb(xf, yf, threshold)
+
+
+def _plot(original):
+    def plot(self, *args, data=None, **kwargs):
+        # Simple calls only: plot(y), plot(y, fmt), plot(x, y) and plot(x, y, fmt)
+        fmt = args[-1:] if args and isinstance(args[-1], str) else ()
+        values = args[:len(args) - len(fmt)]
+        if data is not None or not 1 <= len(values) <= 2 or _length(values[-1]) is None:
+            return original(self, *args, data=data, **kwargs)
+        y = values[-1]
+        if len(values) == 2:
+            x = values[0]
+        else:
+            from matplotlib.cbook import index_of
+            x, y = index_of(y)
+        if _length(x) != _length(y):
+            return original(self, *args, data=data, **kwargs)
+        index = line_points(x, y)
+        if index is None:
+            return original(self, *args, data=data, **kwargs)
+        n = len(y)
+        return original(self, _take(x, index, n), _take(y, index, n), *fmt, **kwargs)
+    return plot
+
+
+def _keep_sampled(points, index, n):
+    # Per point colors and sizes set after the call (as seaborn does for hue and size) follow the sample
+    for name in ("set_facecolor", "set_facecolors", "set_edgecolor", "set_edgecolors", "set_sizes",
+                 "set_array", "set_linewidth", "set_linewidths"):
+        setter = getattr(points, name, None)
+        if setter is not None:
+            setattr(points, name, lambda value, *args, _setter=setter, **kwargs:
+                    _setter(_take(value, index, n), *args, **kwargs))
+    return points
+
+
+def _scatter(original):
+    # Scatter plots of too many points draw a random sample of them.  The call is otherwise unchanged, so
+    # colors, labels and markers are kept and the script still gets the PathCollection it asked for.
+    def scatter(self, x, y, s=None, c=None, *args, data=None, **kwargs):
+        n = _length(x)
+        if data is not None or n is None or n <= MAX_SCATTER_POINTS or _length(y) != n:
+            return original(self, x, y, s, c, *args, data=data, **kwargs)
+        index = sample(n, MAX_SCATTER_POINTS)
+        kwargs = {key: _take(value, index, n) for key, value in kwargs.items()}
+        points = original(self, _take(x, index, n), _take(y, index, n), _take(s, index, n), _take(c, index, n),
+                          *args, **kwargs)
+        return _keep_sampled(points, index, n)
+    return scatter
+
+
+def _note_cap(ax, shown, total):
+    # Say above the right end of the plot that only some categories are drawn, where the script's own
+    # title does not replace it
+    if hasattr(ax, "annotate"):
+        ax.annotate("The %d largest of %d categories" % (shown, total), xy=(1, 1), xycoords="axes fraction",
+                    xytext=(0, 4), textcoords="offset points", ha="right", va="bottom", fontsize="small",
+                    color="grey")
+
+
+def _bar(original, names):
+    # Bars of text categories beyond MAX_CATEGORIES: only the largest are drawn.
+    # names are the categories and the bar lengths, (x, height) for bar and (y, width) for barh.
+    def bar(self, *args, data=None, **kwargs):
+        if data is not None or len(args) > 2 or not all(
+                len(args) > i or name in kwargs for i, name in enumerate(names)):
+            return original(self, *args, data=data, **kwargs)
+        kwargs = dict(kwargs)
+        categories, lengths = [args[i] if len(args) > i else kwargs.pop(name) for i, name in enumerate(names)]
+        n = _length(categories)
+        if n is None or n <= MAX_CATEGORIES or _length(lengths) != n or not _is_text(categories):
+            return original(self, categories, lengths, **kwargs)
+        index = top_categories(lengths, MAX_CATEGORIES)
+        kwargs = {key: _take(value, index, n) for key, value in kwargs.items()}
+        bars = original(self, _take(categories, index, n), _take(lengths, index, n), **kwargs)
+        _note_cap(self, len(index), n)
+        return bars
+    return bar
+
+
+def _pie(original):
+    # Wedges beyond MAX_CATEGORIES: the largest are drawn and the rest are added up as "Other"
+    def pie(self, x, *args, data=None, **kwargs):
+        n = _length(x)
+        if data is not None or args or n is None or n <= MAX_CATEGORIES:
+            return original(self, x, *args, data=data, **kwargs)
+        values = np.asarray(x, dtype=float)
+        index = top_categories(values, MAX_CATEGORIES - 1)
+        rest = np.ones(n, dtype=bool)
+        rest[index] = False
+        capped = {}
+        for key, value in kwargs.items():
+            if _length(value) != n:
+                capped[key] = value
+            elif key == "labels":
+                capped[key] = list(np.asarray(value, dtype=object)[index]) + ["Other"]
+            elif key == "explode":
+                capped[key] = list(np.asarray(value)[index]) + [0]
+            elif key == "colors":
+                capped[key] = list(np.asarray(value, dtype=object)[index]) + ["lightgrey"]
+            else:
+                return original(self, x, data=data, **kwargs)
+        return original(self, np.append(values[index], values[rest].sum()), **capped)
+    return pie
+
+
+def _pandas_plot(original):
+    # Bar charts of a Series or DataFrame with too many text categories (the index, or the x column) keep
+    # the rows with the largest values, and say so above the plot.  Numbers and dates along the axis,
+    # such as years, are an ordered range and are never cut.
+    def __call__(self, *args, **kwargs):
+        frame = self._parent
+        if kwargs.get("kind") not in ("bar", "barh") or len(frame) <= MAX_CATEGORIES:
+            return original(self, *args, **kwargs)
+        x = kwargs.get("x")
+        categories = frame[x] if x is not None and getattr(frame, "ndim", 1) == 2 else frame.index
+        if getattr(categories, "ndim", 1) != 1 or not _is_text(categories):
+            return original(self, *args, **kwargs)
+        if getattr(frame, "ndim", 1) == 1:
+            values = frame
+        else:
+            columns = kwargs.get("y")
+            numeric = frame[columns] if columns is not None else frame.drop(columns=kwargs.get("x") or [])
+            values = numeric.select_dtypes("number") if getattr(numeric, "ndim", 1) == 2 else numeric
+            if getattr(values, "ndim", 1) == 2:
+                if values.shape[1] == 0:
+                    return original(self, *args, **kwargs)
+                values = values.abs().sum(axis=1)
+        if _as_float(values) is None:
+            return original(self, *args, **kwargs)
+        capped = frame.iloc[top_categories(values, MAX_CATEGORIES)]
+        result = original(type(self)(capped), *args, **kwargs)
+        for ax in np.ravel(result):
+            _note_cap(ax, len(capped), len(frame))
+        return result
+    return __call__
+
+
+def _largest_bars(data, column, kwargs):
+    # Sizes of the bars of a seaborn plot per category: counts, or for a bar plot the value it draws
+    counts = data[column].value_counts()
+    other = kwargs.get("y" if column == kwargs.get("x") else "x")
+    if not isinstance(other, str) or other not in data.columns or _as_float(data[other]) is None:
+        return counts
+    try:
+        return data.groupby(column, observed=True)[other].agg(kwargs.get("estimator", "mean")).abs()
+    except Exception:
+        return counts
+
+
+def _seaborn_categorical(original, by_value):
+    # Count and bar plots of a column with too many categories show the largest bars, the most frequent
+    # categories for a count plot and the largest estimates for a bar plot, in their usual order
+    def plot(*args, **kwargs):
+        data = kwargs.get("data", args[0] if args else None)
+        total = None
+        if kwargs.get("order") is None and hasattr(data, "columns"):
+            for axis in ("x", "y"):
+                column = kwargs.get(axis)
+                if isinstance(column, str) and column in data.columns and _as_float(data[column]) is None:
+                    sizes = _largest_bars(data, column, kwargs) if by_value else data[column].value_counts()
+                    if len(sizes) > MAX_CATEGORIES:
+                        total = len(sizes)
+                        largest = set(sizes.sort_values(ascending=False, kind="stable").index[:MAX_CATEGORIES])
+                        kwargs["order"] = [value for value in data[column].dropna().unique() if value in largest]
+                    break
+        ax = original(*args, **kwargs)
+        if total is not None:
+            _note_cap(ax, MAX_CATEGORIES, total)
+        return ax
+    return plot
+
+
+def install():
+    # Put the limits in front of the plotting calls of matplotlib, pandas and seaborn.  Called once in
+    # each plotting worker, before any generated script runs.
+    global _installed
+    if _installed or DOWNSAMPLING_DISABLED:
+        return
+    from matplotlib.axes import Axes
+    Axes.plot = _plot(Axes.plot)
+    Axes.scatter = _scatter(Axes.scatter)
+    Axes.bar = _bar(Axes.bar, ("x", "height"))
+    Axes.barh = _bar(Axes.barh, ("y", "width"))
+    Axes.pie = _pie(Axes.pie)
+    from pandas.plotting import PlotAccessor
+    PlotAccessor.__call__ = _pandas_plot(PlotAccessor.__call__)
+    try:
+        import seaborn
+    except ImportError:
+        seaborn = None
+    if seaborn is not None:
+        seaborn.countplot = _seaborn_categorical(seaborn.countplot, by_value=False)
+        seaborn.barplot = _seaborn_categorical(seaborn.barplot, by_value=True)
+    _installed = True
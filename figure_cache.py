@@ -0,0 +1,55 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+# Memory allowed for rendered figures, in MB
+FIGURE_CACHE_MB = float(os.environ.get("FIGURE_CACHE_MB", "100"))
+
+
+class FigureCache:
+    # Rendered figures keyed on the hash of the final script and the fingerprint of its dataset,
+    # so a byte-identical script on byte-identical data is never drawn twice.
+    # Holds at most max_mb of images and drops the least recently used first.
+
+    def __init__(self, max_mb=FIGURE_CACHE_MB):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(script, dataset_fingerprint, image_format="png"):
+        return hashlib.sha256("\x1f".join([image_format, dataset_fingerprint, script]).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._images.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        if len(image) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._images:
+                self._size -= len(self._images.pop(key))
+            self._images[key] = image
+            self._size += len(image)
+            while self._size > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._images), "bytes": self._size}
+
+
+# Cache shared by every session in the process
+figure_cache = FigureCache()
@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Rows parsed at a time, and rows kept in memory as a sample of the whole file
+CHUNK_ROWS = int(os.environ.get("INGEST_CHUNK_ROWS", "200000"))
+SAMPLE_ROWS = int(os.environ.get("INGEST_SAMPLE_ROWS", "50000"))
+# Same limit as get_primer: columns with fewer distinct values have them listed
+CATEGORY_LIMIT = 20
+
+
+def _column_kind(dtype):
+    if pd.api.types.is_bool_dtype(dtype):
+        return "bool"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "int"
+    if pd.api.types.is_float_dtype(dtype):
+        return "float"
+    return "text"
+
+
+def _combine_kinds(old, new):
+    # The kind which holds the values of both chunks
+    if old is None or old == new:
+        return new
+    if {old, new} == {"int", "float"}:
+        return "float"
+    return "text"
+
+
+def _read_chunks(source, dtype=None):
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return pd.read_csv(source, chunksize=CHUNK_ROWS, dtype=dtype)
+
+
+def ingest_csv(source, path, sample_rows=SAMPLE_ROWS, seed=0):
+    # Read a CSV too big to parse in one go, chunk by chunk, and write all of it to a Parquet file at path.
+    # Returns (sample, profile, rows): a uniform reservoir sample of the rows in file order, a profile
+    # in the same form as classes.profile_dataset computed over every row, and the number of rows.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # First pass: settle each column's type, count rows, collect small category sets and the sample
+    rng = np.random.default_rng(seed)
+    kinds = {}
+    distinct = {}
+    reservoir = []
+    rows = 0
+    columns = None
+    for chunk in _read_chunks(source):
+        if columns is None:
+            columns = list(chunk.columns)
+            distinct = {column: {} for column in columns}
+        for column, dtype in chunk.dtypes.items():
+            kinds[column] = _combine_kinds(kinds.get(column), _column_kind(dtype))
+            values = distinct[column]
+            if values is not None:
+                for value in pd.unique(chunk[column]):
+                    values.setdefault(str(value), None)
+                if len(values) >= CATEGORY_LIMIT:
+                    # Too many to list, stop tracking this column
+                    distinct[column] = None
+        # Reservoir sampling (algorithm R), vectorized over the chunk
+        positions = np.arange(rows, rows + len(chunk))
+        slots = np.where(positions < sample_rows, positions, rng.integers(0, positions + 1))
+        accepted = np.flatnonzero(slots < sample_rows)
+        records = chunk.iloc[accepted].itertuples(index=False, name=None)
+        for position, slot, record in zip(positions[accepted], slots[accepted], records):
+            if position < sample_rows:
+                reservoir.append((position, record))
+            else:
+                reservoir[slot] = (position, record)
+        rows += len(chunk)
+
+    final_dtypes = {column: {"int": "int64", "float": "float64", "bool": "bool"}.get(kind, "object")
+                    for column, kind in kinds.items()}
+
+    # Second pass: parse again with the settled types and append each chunk to the Parquet file
+    writer = None
+    try:
+        for chunk in _read_chunks(source, dtype={c: (str if t == "object" else t) for c, t in final_dtypes.items()}):
+            if writer is None:
+                schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                schema = pa.schema([pa.field(f.name, pa.string()) if final_dtypes[f.name] == "object" else f
+                                    for f in schema])
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    finally:
+        if writer is not None:
+            writer.close()
+
+    reservoir.sort(key=lambda item: item[0])
+    sample = pd.DataFrame([record for _, record in reservoir], columns=columns)
+    for column, dtype in final_dtypes.items():
+        if dtype != "object":
+            sample[column] = sample[column].astype(dtype)
+
+    profile = []
+    for column in columns:
+        kind = kinds[column]
+        values = distinct[column]
+        if kind == "text":
+            kind, dtype = "categorical", "object"
+        elif kind in ("int", "float"):
+            kind, dtype = "numeric", final_dtypes[column]
+        else:
+            kind, dtype = "other", final_dtypes[column]
+        # Exact when the values were all tracked, otherwise at least the number seen in the sample
+        cardinality = len(values) if values is not None else max(CATEGORY_LIMIT, int(sample[column].nunique()))
+        profile.append({"name": str(column), "kind": kind, "dtype": dtype, "cardinality": cardinality,
+                        "values": list(values) if values is not None and kind == "categorical" else None})
+    return sample, profile, rows
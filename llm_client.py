@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+
+from dotenv import load_dotenv, find_dotenv
+
+from tracing import observe
+
+# Load the .env file once for the whole process, OPENAI_API_KEY is read from it when the client is built.
+# httpx, openai and langchain_openai are only imported when the first client is needed.
+_started = time.perf_counter()
+_ = load_dotenv(find_dotenv())  # read local .env file
+observe("dotenv_load", time.perf_counter() - _started)
+
+# Connection pool and timeouts, can be tuned from the environment or the .env file
+POOL_SIZE = int(os.environ.get("OPENAI_POOL_SIZE", "20"))
+KEEPALIVE_SIZE = int(os.environ.get("OPENAI_KEEPALIVE_SIZE", "10"))
+REQUEST_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "60"))
+CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", "10"))
+
+_http_client = None
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client():
+    # One pooled HTTP client for every OpenAI call so keep-alive connections and TLS sessions are reused
+    global _http_client
+    if _http_client is None:
+        import httpx
+        with _client_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(
+                    limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=KEEPALIVE_SIZE),
+                    timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT))
+    return _http_client
+
+
+def get_client():
+    # Shared OpenAI client, safe to use from several threads at once
+    global _client
+    if _client is None:
+        from openai import OpenAI
+        http_client = get_http_client()
+        with _client_lock:
+            if _client is None:
+                # Retries are left to rate_limiter.scheduler, which backs off across every session
+                _client = OpenAI(http_client=http_client, timeout=REQUEST_TIMEOUT, max_retries=0)
+    return _client
+
+
+_chat_class = None
+
+
+def _without_usage(result):
+    # Copy of a chat result or stream chunk without its token usage, for the callers who shared a
+    # request, so the tokens of one request are only counted once
+    from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+    if isinstance(result, ChatGenerationChunk):
+        if not getattr(result.message, "usage_metadata", None):
+            return result
+        return ChatGenerationChunk(message=result.message.copy(update={"usage_metadata": None}),
+                                   generation_info=result.generation_info)
+    generations = [ChatGeneration(message=generation.message.copy(update={"usage_metadata": None}),
+                                  generation_info=generation.generation_info) for generation in result.generations]
+    return ChatResult(generations=generations, llm_output=dict(result.llm_output or {}, token_usage={}))
+
+
+def _scheduled_chat_class():
+    # ChatOpenAI whose requests wait for the model's quota in rate_limiter.scheduler and are retried there,
+    # so the chains and the conversation summaries share the quota fairly with run_request and moderation
+    global _chat_class
+    if _chat_class is None:
+        from langchain_openai import ChatOpenAI
+        from rate_limiter import scheduler, estimate_tokens, COMPLETION_ESTIMATE
+        from single_flight import single_flight
+
+        class ScheduledChatOpenAI(ChatOpenAI):
+
+            def _estimate(self, messages):
+                return (sum(estimate_tokens(str(message.content)) for message in messages)
+                        + (self.max_tokens or COMPLETION_ESTIMATE))
+
+            def _flight_key(self, messages, stop, kwargs):
+                # Requests at temperature 0 for the same messages are coalesced by single_flight, a
+                # higher temperature asks for a different reply each time
+                if self.temperature:
+                    return None
+                return (self.model_name, self.max_tokens, self.streaming, repr(stop), repr(sorted(kwargs.items())),
+                        tuple((message.type, str(message.content)) for message in messages))
+
+            def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+                if self.streaming:
+                    # Streamed through _stream below, which waits for the quota itself
+                    return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                generate = lambda: scheduler.call(
+                    lambda: super(ScheduledChatOpenAI, self)._generate(messages, stop=stop, run_manager=run_manager,
+                                                                       **kwargs),
+                    self.model_name, self._estimate(messages),
+                    usage=lambda result: (result.llm_output or {}).get("token_usage", {}).get("total_tokens", 0))
+                key = self._flight_key(messages, stop, kwargs)
+                if key is None:
+                    return generate()
+                return single_flight.do(key, generate, shared=_without_usage)
+
+            def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+                # Only the start of a reply is retried, until the first chunk arrives
+                def start():
+                    chunks = super(ScheduledChatOpenAI, self)._stream(messages, stop=stop, **kwargs)
+                    return chunks, next(chunks, None)
+
+                def upstream():
+                    chunks, first = scheduler.call(start, self.model_name, self._estimate(messages))
+                    if first is None:
+                        return
+                    yield first
+                    yield from chunks
+
+                key = self._flight_key(messages, stop, kwargs)
+                chunks = upstream() if key is None else single_flight.stream(key, upstream, shared=_without_usage)
+                # Tokens are passed on here rather than upstream, so every caller of a shared stream sees them
+                try:
+                    for chunk in chunks:
+                        if run_manager:
+                            run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                        yield chunk
+                finally:
+                    # A caller which stops early (e.g. moderation withheld the reply) leaves the shared stream
+                    chunks.close()
+
+        _chat_class = ScheduledChatOpenAI
+    return _chat_class
+
+
+_chat_models = {}
+
+
+def chat_model(model_name, temperature=0, max_tokens=None, streaming=False):
+    # LangChain chat model which sends its requests through the shared connection pool and the
+    # shared rate limit scheduler.  With streaming=True tokens are passed to the on_llm_new_token
+    # callbacks as they arrive.
+    # Models hold no per-request state, so one instance per setting is shared by every page and session
+    key = (model_name, temperature, max_tokens, streaming)
+    model = _chat_models.get(key)
+    if model is None:
+        chat_class = _scheduled_chat_class()
+        http_client = get_http_client()
+        with _client_lock:
+            if key not in _chat_models:
+                # Streamed replies still report their token usage, for tracing
+                _chat_models[key] = chat_class(model_name=model_name, temperature=temperature, max_tokens=max_tokens,
+                                               streaming=streaming, stream_usage=streaming, http_client=http_client,
+                                               request_timeout=REQUEST_TIMEOUT, max_retries=0)
+            model = _chat_models[key]
+    return model
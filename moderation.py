@@ -0,0 +1,55 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from llm_client import get_client
+from rate_limiter import scheduler
+from tracing import span, run_in_context
+
+# Number of moderation verdicts remembered, the oldest are forgotten first
+MODERATION_CACHE_SIZE = 4096
+
+_verdicts = OrderedDict()
+_verdicts_lock = threading.Lock()
+_moderation_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="moderation")
+
+
+def _content_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _cached_verdict(key):
+    with _verdicts_lock:
+        if key in _verdicts:
+            _verdicts.move_to_end(key)
+            return _verdicts[key]
+    return None
+
+
+def is_flagged(text):
+    # Ask OpenAI whether the post contains harmful language, verdicts are memoized by content hash
+    key = _content_key(text)
+    flagged = _cached_verdict(key)
+    if flagged is not None:
+        return flagged
+    with span("moderation"):
+        # Moderation has its own quota, it does not count towards the chat models' tokens
+        moderate_dict = scheduler.call(lambda: get_client().moderations.create(input=text), "moderation").model_dump()
+    flagged = moderate_dict["results"][0]["flagged"]
+    with _verdicts_lock:
+        _verdicts[key] = flagged
+        while len(_verdicts) > MODERATION_CACHE_SIZE:
+            _verdicts.popitem(last=False)
+    return flagged
+
+
+def check_async(text):
+    # Start moderating the post and return a Future of is_flagged(text),
+    # so the reply can be generated while the check is running
+    flagged = _cached_verdict(_content_key(text))
+    if flagged is not None:
+        future = Future()
+        future.set_result(flagged)
+        return future
+    return _moderation_pool.submit(run_in_context(is_flagged), text)
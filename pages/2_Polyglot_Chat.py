@@ -1,23 +1,26 @@
-import os
-import openai
 import sys
-import streamlit as st
 import time
+import streamlit as st
 
-from langchain_openai import ChatOpenAI
 from langchain.chains import LLMChain
 from langchain.prompts import (PromptTemplate)
-from langchain.memory import (ConversationBufferMemory)
 
 sys.path.append('../..')
 
-from dotenv import load_dotenv, find_dotenv
-_ = load_dotenv(find_dotenv()) # read local .env file
-
-openai.api_key  = os.environ['OPENAI_API_KEY']
+# Shared OpenAI client and connection pool, also loads the API key
+from llm_client import chat_model
+from streaming import StreamHandler, ReplyWithheld, TokenUsageHandler
+from moderation import check_async
+from tracing import trace, span, start_metrics_server
+from chat_store import session_history
+from dictionary import dictionary
+from similar_replies import similar_replies, reply_namespace
 
 available_models = {"ChatGPT-3.5": "gpt-3.5-turbo", "ChatGPT-4": "gpt-4"}
 
+# Serve the timing and token metrics of every page
+start_metrics_server()
+
 st.title('Polyglot Chat')
 with st.expander('Instructions'):
     st.markdown(':green[*either* ]:orange[ type any word or phrase into the chat below]')
@@ -47,46 +50,50 @@ with st.sidebar:
             ('Confucius', 'Lao Tse', 'Wang Wei', 'Luo Guanzhong', 'Lu Xun')
         )
 
+    with st.container(border=True):
+        # Keep a dictionary of whether models are selected or not
+        use_model = st.selectbox(':brain: Choose your model(s):',available_models.keys())
+        # Assign temperature for AI
+        use_model = available_models[use_model]
+        aiTemp = st.slider(':sparkles: Choose AI variance or creativity:', 0.0, 1.0, 0.0, 0.1)
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def polyglot_chains(model_name, temperature, language, author):
+    # Prompts, model and chains for one language and author, built once and shared by every session and rerun
     title_template = PromptTemplate(
         input_variables = ['concept'],
-        partial_variables = {'language': option},
+        partial_variables = {'language': language},
         template='Completely ignore the letters, "q" and "s" that {concept} begins with, then give the dictionary entry for the {language} word.'
     )
 
     script_template = PromptTemplate(
         input_variables = ['convo'],
-        partial_variables = {'language': option, 'author': author_option},
+        partial_variables = {'language': language, 'author': author},
         template='''
         Do not repeat {convo} when responding. If {convo} is in English, reply to it in {language}.  
         Reply in {language} to {convo} with no English translation.  
         Use the {language} in the style of {author}.  Be thorough and complete in your response.'''
     )
+    model = chat_model(model_name, temperature=temperature, max_tokens=400, streaming=True)
+    chainT = LLMChain(llm=model, prompt=title_template, verbose=True, output_key='title')
+    chainS = LLMChain(llm=model, prompt=script_template, verbose=True, output_key='script')
+    return chainT, chainS
 
-    with st.container(border=True):
-        # Keep a dictionary of whether models are selected or not
-        use_model = st.selectbox(':brain: Choose your model(s):',available_models.keys())
-        # Assign temperature for AI
-        use_model = available_models[use_model]
-        aiTemp = st.slider(':sparkles: Choose AI variance or creativity:', 0.0, 1.0, 0.0, 0.1)
 
-memoryS = ConversationBufferMemory(memory_key='chat_history', return_messages=True)
-model = ChatOpenAI(temperature=aiTemp, max_tokens=400, model_name=use_model)
-chainT = LLMChain(llm=model, prompt=title_template, verbose=True, output_key='title')
-chainS = LLMChain(llm=model, prompt=script_template, verbose=True, output_key='script', memory=memoryS)
+# Messages of this conversation, the latest in memory and all of them in the chat store
+messages = session_history("polyglot")
+chainT, chainS = polyglot_chains(use_model, aiTemp, option, author_option)
 
 with st.sidebar:
     # reset button
     if st.button("Clear Messages", type="primary"):
         # streamlit_js_eval(js_expressions="parent.window.location.reload()")
-        st.session_state.messages.clear()
-        memoryS.clear()
-
-# Initialize chat history
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+        messages.clear()
 
-# Display chat messages from history on app rerun
-for message in st.session_state.messages:
+# Display the latest chat messages on app rerun, earlier ones are read from the chat store when asked for
+if messages.has_earlier() and st.button("Show earlier messages"):
+    messages.show_earlier()
+for message in messages.messages():
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
@@ -95,50 +102,63 @@ if input_text := st.chat_input("Quid agis?"):
     with st.chat_message("user"):
         st.markdown(input_text)
     # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": input_text})
+    messages.add("user", input_text)
 
 # Display the output if the the user gives an input - qs = define, else converse
 if input_text and input_text[:2] == "qs":
-    with st.chat_message("assistant"):
+    with st.chat_message("assistant"), trace("polyglot_define"):
         message_placeholder = st.empty()
 
-        # moderate the post for harmful language
-        from openai import OpenAI
-        client = OpenAI()
-        moderate_dict = client.moderations.create(input=input_text).model_dump()
-        is_flagged = moderate_dict["results"][0]["flagged"]
-        if is_flagged == True:
-            st.write("There is something inappropriate about what you asked.")
+        # Words already in the local dictionary (bundled or looked up before) need no model or moderation call
+        word = input_text[2:].strip()
+        with span("dictionary", language=option) as attributes:
+            entry = dictionary.lookup(option, word)
+            attributes["hit"] = entry is not None
+        if entry is not None:
+            message_placeholder.markdown(entry)
+            messages.add("assistant", entry)
         else:
-            title = chainT.invoke(input_text)
-            message_placeholder.markdown(title)
-            st.session_state.messages.append({"role": "assistant", "content": title})
+            # moderate the post for harmful language while the definition is being written
+            flagged = check_async(input_text)
+            title = None
+            # A verdict which is already known (the same text was flagged before) needs no definition at all
+            if not (flagged.done() and flagged.result() == True):
+                with span("llm", model=use_model):
+                    title = chainT.invoke(input_text, config={"callbacks": [TokenUsageHandler()]})["title"]
+            if flagged.result() == True:
+                st.write("There is something inappropriate about what you asked.")
+            else:
+                message_placeholder.markdown(title)
+                messages.add("assistant", title)
+                # Only answers which passed moderation are remembered
+                dictionary.add(option, word, title)
 
 elif input_text:
-    with st.chat_message("assistant"):
+    with st.chat_message("assistant"), trace("polyglot"):
         message_placeholder = st.empty()
-        full_response = ""
-
-        # moderate the post for harmful language
-        from openai import OpenAI
-        client = OpenAI()
-        moderate_dict = client.moderations.create(input=input_text).model_dump()
-        is_flagged = moderate_dict["results"][0]["flagged"]
-        if is_flagged == True:
+
+        # moderate the post for harmful language while the reply is being written
+        flagged = check_async(input_text)
+        # Stream the reply into the placeholder as the model writes it, once moderation has passed
+        stream = StreamHandler(message_placeholder, gate=flagged)
+        # At temperature 0 the author's reply to a nearly identical message is reused
+        reply_key = reply_namespace("polyglot", use_model, aiTemp, language=option, author=author_option)
+        # A verdict which is already known (the same text was flagged before) needs no reply at all
+        blocked = flagged.done() and flagged.result() == True
+        reply = None if blocked else similar_replies.lookup(reply_key, input_text, aiTemp)
+        llm_seconds = None
+        if reply is None and not blocked:
+            try:
+                started = time.perf_counter()
+                with span("llm", model=use_model):
+                    reply = chainS.invoke(input_text, config={"callbacks": [stream, TokenUsageHandler()]})["script"]
+                llm_seconds = time.perf_counter() - started
+            except ReplyWithheld:
+                reply = None
+        if reply is None or flagged.result() == True:
             st.write("There is something inappropriate about what you asked.")
         else:
-            with st.spinner("Thinking..."):
-                if st.session_state.messages:
-                    for i in range(len(st.session_state.messages)):
-                        if "content" in st.session_state.messages[i] and st.session_state.messages[i]["role"] == "user":
-                            question = st.session_state.messages[i]["content"]
-                        if "content" in st.session_state.messages[i] and st.session_state.messages[i]["role"] == "assistant":
-                            answer = st.session_state.messages[i]["content"]
-                            memoryS.save_context({"input": question}, {"output": answer})
-                script = chainS.invoke(input_text)
-            for letter in script["script"]:
-                full_response += letter + ("")
-                time.sleep(0.02)
-                message_placeholder.markdown(full_response + "▌")
-            message_placeholder.markdown(full_response)
-            st.session_state.messages.append({"role": "assistant", "content": full_response})
+            full_response = stream.finish(reply)
+            if llm_seconds is not None:
+                similar_replies.put(reply_key, input_text, full_response, aiTemp, llm_seconds)
+            messages.add("assistant", full_response)
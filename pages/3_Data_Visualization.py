@@ -1,14 +1,13 @@
-import pandas as pd
 import streamlit as st
-from classes import get_primer, format_question, run_request
+from classes import get_primer, format_question, run_requests, dataset_fingerprint, count_tokens
+from dataset_registry import registry, SessionDatasets
+from plot_worker import render_script, warm_up
+from figure_cache import figure_cache
+from response_cache import response_cache
+from tracing import trace, span, start_metrics_server
 import warnings
 
-import matplotlib
-import matplotlib.pyplot as pyplot
-import seaborn as sns
-
 warnings.filterwarnings("ignore")
-st.set_option('deprecation.showPyplotGlobalUse', False)
 st.set_page_config(page_icon="chat2vis.png", layout="wide", page_title="Chat2VIS")
 
 st.markdown("<h1 style='text-align: center; font-weight:bold; padding-top: 0rem;'> \
@@ -20,22 +19,32 @@ st.markdown("<h2 style='text-align: center;padding-top: 0rem;'>Creating Visualis
 #    unsafe_allow_html=True)
 
 available_models = {"ChatGPT-4": "gpt-4", "ChatGPT-3.5": "gpt-3.5-turbo"}
+# Rows shown per page of the dataset preview
+PREVIEW_ROWS = 100
+
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def preview_table(dataset_key, start, rows):
+    # A page of a dataset converted to Arrow once and shared by every session and rerun
+    import pyarrow as pa
+    return pa.Table.from_pandas(registry.preview(dataset_key, start, rows), preserve_index=False)
 
-# List to hold datasets
+
+# Start the plotting processes so they are ready by the time the first script arrives
+warm_up()
+# Serve the timing and token metrics of every page
+start_metrics_server()
+
+# The datasets this session can choose from, loaded from the shared registry when first used
 if "datasets" not in st.session_state:
-    datasets = {}
-    # Preload datasets
-    datasets["Movies"] = pd.read_csv("movies.csv")
-    datasets["Housing"] = pd.read_csv("housing.csv")
-    datasets["Cars"] = pd.read_csv("cars.csv")
-    datasets["Colleges"] = pd.read_csv("colleges.csv")
-    datasets["Customers & Products"] = pd.read_csv("customers_and_products_contacts.csv")
-    datasets["Department Store"] = pd.read_csv("department_store.csv")
-    datasets["Energy Production"] = pd.read_csv("energy_production.csv")
-    st.session_state["datasets"] = datasets
-else:
-    # use the list already loaded
-    datasets = st.session_state["datasets"]
+    st.session_state["datasets"] = SessionDatasets(registry)
+datasets = st.session_state["datasets"]
+# Uploads nobody has used for a while are deleted, forget them so they are loaded again if still selected
+expired_uploads = datasets.remove_missing()
+if expired_uploads:
+    upload_keys = st.session_state.get("upload_keys", {})
+    for upload_id in [upload_id for upload_id, key in upload_keys.items() if not registry.has(key)]:
+        del upload_keys[upload_id]
 
 with st.sidebar:
     # First we want to choose the dataset, but we will fill it with choices once we've loaded one
@@ -49,13 +58,22 @@ with st.sidebar:
             if uploaded_file:
                 # Read in the data, add it to the list of available datasets. Give it a nice name.
                 file_name = uploaded_file.name[:-4].capitalize()
-                datasets[file_name] = pd.read_csv(uploaded_file)
+                # The same upload is only hashed once per session and parsed once per process
+                upload_keys = st.session_state.setdefault("upload_keys", {})
+                upload_id = getattr(uploaded_file, "file_id", None) or uploaded_file.name
+                if upload_id not in upload_keys:
+                    upload_keys[upload_id] = registry.add_upload(uploaded_file.getvalue())
+                file_name = datasets.add(file_name, upload_keys[upload_id])
                 # We want to default the radio button to the newly added dataset
-                index_no = len(datasets) - 1
+                index_no = list(datasets).index(file_name)
     except Exception as e:
         st.error("File failed to load. Please select a valid CSV file.")
         print("File failed to load.\n" + str(e))
 
+    for name in expired_uploads:
+        if name not in datasets:
+            st.warning(name + " is no longer available, please upload it again.")
+
     # Radio buttons for dataset choice
     chosen_dataset = dataset_container.radio(":bar_chart: Choose your data:", datasets.keys(),
                                              index=index_no)  # ,horizontal=True,)
@@ -79,50 +97,82 @@ with st.sidebar:
 
 # Text area for query
 question = st.text_area(":eyes: What would you like to visualize?", height=10)
-go_btn = st.button("Go...")
+go_col, regenerate_col = st.columns([1, 8])
+go_btn = go_col.button("Go...")
+# Ask the models again instead of showing the answers stored for this question
+regenerate_btn = regenerate_col.button("Regenerate")
 
 # Make a list of the models which have been selected
 selected_models = [model_name for model_name, choose_model in use_model.items() if choose_model]
 model_count = len(selected_models)
 
 # Execute chatbot query
-if go_btn and model_count > 0:
-    # Place for plots depending on how many models
-    plots = st.columns(model_count)
-    # Get the primer for this dataset
-    primer1, primer2 = get_primer(datasets[chosen_dataset], 'datasets["' + chosen_dataset + '"]')
-    # Create model, run the request and print the results
-    for plot_num, model_type in enumerate(selected_models):
-        with plots[plot_num]:
-            st.subheader(model_type)
-            try:
-                # Format the question
-                question_to_ask = format_question(primer1, primer2, question, model_type)
-                # Run the question
-                answer = ""
-                answer = run_request(question_to_ask, available_models[model_type])
-
-                # the answer is the completed Python script so add to the beginning of the script to it.
-                answer = primer2 + answer
-                print("Model: " + model_type)
-                print(answer)
-                plot_area = st.empty()
-                plot_area.pyplot(exec(answer))
-
-            except Exception as error:
-                st.error(error)
-
-# Display the datasets in a list of tabs
-# Create the tabs
-tab_list = st.tabs(datasets.keys())
-
-# Load up each tab with a dataset
-for dataset_num, tab in enumerate(tab_list):
-    with tab:
-        # Can't get the name of the tab! Can't index key list. So convert to list and index
-        dataset_name = list(datasets.keys())[dataset_num]
-        st.subheader(dataset_name)
-        st.dataframe(datasets[dataset_name], hide_index=True)
+if (go_btn or regenerate_btn) and model_count > 0:
+    # Time every stage of this click, from the primer to the rendered plots
+    with trace("visualize"):
+        # Place for plots depending on how many models
+        plots = st.columns(model_count)
+        # Format the question for each model and show where its plot will go
+        questions = {}
+        for plot_num, model_type in enumerate(selected_models):
+            model_name = available_models[model_type]
+            with plots[plot_num]:
+                st.subheader(model_type)
+                try:
+                    # Get the primer for this dataset, fitted to the model's token budget with the columns
+                    # the question refers to described first.
+                    # Large uploads bring the profile of every row with them, the dataframe here is only a sample
+                    with span("primer", model=model_name) as attributes:
+                        primer1, primer2 = get_primer(datasets[chosen_dataset], 'datasets["' + chosen_dataset + '"]',
+                                                      registry.profile_of(datasets.keys_by_name[chosen_dataset]),
+                                                      question, model_name)
+                        question_to_ask = format_question(primer1, primer2, question, model_type)
+                        attributes["prompt_tokens"] = count_tokens(question_to_ask, model_name)
+                    questions[model_type] = (question_to_ask, model_name)
+                    st.caption(f"Prompt: {attributes['prompt_tokens']:,} tokens")
+                except Exception as error:
+                    st.error(error)
+        # Run the requests at the same time and print the results as each model finishes
+        for model_type, answer, error in run_requests(questions, use_cache=not regenerate_btn):
+            with plots[selected_models.index(model_type)]:
+                try:
+                    if error is not None:
+                        raise error
+                    # the answer is the completed Python script so add to the beginning of the script to it.
+                    answer = primer2 + answer
+                    print("Model: " + model_type)
+                    print(answer)
+                    plot_area = st.empty()
+                    # Show the stored image if this exact script has already been drawn on this data,
+                    # otherwise run the script in a warm worker process and keep the image it draws
+                    figure_key = figure_cache.make_key(answer, dataset_fingerprint(datasets[chosen_dataset]))
+                    image = figure_cache.get(figure_key)
+                    if image is None:
+                        try:
+                            with span("render", model=model_type):
+                                image = render_script(answer, {chosen_dataset: datasets.keys_by_name[chosen_dataset]})
+                        except Exception:
+                            # A script which does not run is not kept, the next Go asks the model again
+                            response_cache.delete(*questions[model_type])
+                            raise
+                        figure_cache.put(figure_key, image)
+                    plot_area.image(image)
+
+                except Exception as error:
+                    st.error(error)
+
+# Display the chosen dataset a page at a time, the other datasets are not sent to the browser at all
+dataset_key = datasets.keys_by_name[chosen_dataset]
+st.subheader(chosen_dataset)
+try:
+    total_rows = registry.rows_of(dataset_key)
+    page_count = max(1, (total_rows - 1) // PREVIEW_ROWS + 1)
+    page = st.number_input("Page", 1, page_count, 1, key="page_" + chosen_dataset)
+    st.caption(f"{total_rows:,} rows, {PREVIEW_ROWS} per page")
+    st.dataframe(preview_table(dataset_key, (page - 1) * PREVIEW_ROWS, PREVIEW_ROWS), hide_index=True)
+except KeyError:
+    # Deleted by another session since this run started, the next rerun forgets it
+    st.error(chosen_dataset + " is no longer available, please upload it again.")
 
 # Insert footer to reference dataset origin
 footer = """<style>.footer {position: fixed;left: 0;bottom: 0;width: 100%;text-align: center;}</style><div class="footer">
@@ -1,25 +1,26 @@
-import os
-import openai
 import sys
-import streamlit as st
 import time
-
-from langchain_openai import ChatOpenAI
+import streamlit as st
 
 from langchain.chains import LLMChain
 from langchain.prompts import (PromptTemplate)
-from langchain.memory import (ConversationSummaryMemory)
 
 sys.path.append('../..')
 
-from dotenv import load_dotenv, find_dotenv
-
-_ = load_dotenv(find_dotenv())  # read local .env file
-
-openai.api_key = os.environ['OPENAI_API_KEY']
+# Shared OpenAI client and connection pool, also loads the API key
+from llm_client import chat_model
+from streaming import StreamHandler, ReplyWithheld, TokenUsageHandler
+from moderation import check_async
+from tracing import trace, span, start_metrics_server
+from chat_memory import SessionMemory
+from chat_store import chat_store, session_history
+from similar_replies import similar_replies, reply_namespace
 
 available_models = {"ChatGPT-3.5": "gpt-3.5-turbo", "ChatGPT-4": "gpt-4"}
 
+# Serve the timing and token metrics of every page
+start_metrics_server()
+
 st.title('Debate AI')
 with st.expander('Instructions'):
     st.markdown(':blue[1. type a topic to debate in the sidebar]')
@@ -48,37 +49,46 @@ with st.sidebar:
         aiTemp = st.slider(':sparkles: Choose AI variance or creativity:', 0.0, 1.0, 0.0, 0.1)
 
 
-# AI template which passes framework for response
-script_template = PromptTemplate(
-    input_variables=['convo'],
-    partial_variables={'topic': topic, 'grade_level': option, 'role': role},
-    template='''
+@st.cache_resource(max_entries=64, show_spinner=False)
+def debate_chain(model_name, temperature, topic, grade_level, role):
+    # Prompt, model and chain for one debate, built once and shared by every session and rerun
+    # AI template which passes framework for response
+    script_template = PromptTemplate(
+        input_variables=['convo', 'history'],
+        partial_variables={'topic': topic, 'grade_level': grade_level, 'role': role},
+        template='''
         You are a persuasive expert at debating and rhetoric.  The premise of the debate is {topic}.  
         You are arguing {role} the {topic}.  
         Your response to the user should include critique of their {convo} and evidence to support your own arguments.
         Your response should be tailored to someone in grade {grade_level}.
         Be sure to take into account what was said previously: {history} - before responding
         Limit the response to 500 tokens.'''
-)
+    )
+    model = chat_model(model_name, temperature=temperature, max_tokens=500, streaming=True)
+    return LLMChain(llm=model, prompt=script_template, verbose=True, output_key='script')
+
 
-model_mem = ChatOpenAI(temperature=0, max_tokens=250, model_name=use_model)
-model = ChatOpenAI(temperature=aiTemp, max_tokens=500, model_name=use_model)
-memorySt = ConversationSummaryMemory(llm=model_mem, memory_key='history', return_messages=True)
-chainSt = LLMChain(llm=model, prompt=script_template, verbose=True, output_key='script', memory=memorySt)
+model_mem = chat_model(use_model, temperature=0, max_tokens=250)
+# Messages of this conversation, the latest in memory and all of them in the chat store
+messages = session_history("debate")
+# Running summary of the conversation, kept for the whole session and updated in the background,
+# saved with the messages in the chat store
+if "debate_memory" not in st.session_state:
+    st.session_state["debate_memory"] = SessionMemory(chat_store, messages.conversation)
+memorySt = st.session_state["debate_memory"]
+chainSt = debate_chain(use_model, aiTemp, topic, option, role)
 
 with st.sidebar:
     # reset button
     if st.button("Clear Messages", type="primary"):
         # streamlit_js_eval(js_expressions="parent.window.location.reload()")
-        st.session_state.messages.clear()
+        messages.clear()
         memorySt.clear()
 
-# Initialize chat history
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-
-# Display chat messages from history on app rerun
-for message in st.session_state.messages:
+# Display the latest chat messages on app rerun, earlier ones are read from the chat store when asked for
+if messages.has_earlier() and st.button("Show earlier messages"):
+    messages.show_earlier()
+for message in messages.messages():
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
@@ -87,37 +97,42 @@ if input_text := st.chat_input("Type Here:"):
     with st.chat_message("user"):
         st.markdown(input_text)
     # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": input_text})
+    messages.add("user", input_text)
 
 # Display the output if the the user types any input
 if input_text:
-    with st.chat_message("assistant"):
+    with st.chat_message("assistant"), trace("debate"):
         message_placeholder = st.empty()
-        full_response = ""
-        # moderate the post for harmful language
-        from openai import OpenAI
-
-        client = OpenAI()
-        moderate_dict = client.moderations.create(input=input_text).model_dump()
-        is_flagged = moderate_dict["results"][0]["flagged"]
-
-        if is_flagged == True:
+        # moderate the post for harmful language while the reply is being written
+        flagged = check_async(input_text)
+        # Stream the reply into the placeholder as the model writes it, once moderation has passed
+        stream = StreamHandler(message_placeholder, gate=flagged)
+        # At temperature 0 the reply to a nearly identical argument on the same topic is reused
+        # The conversation so far is part of the key, so a reply is only reused where it still fits
+        history = memorySt.load()
+        reply_key = reply_namespace("debate", use_model, aiTemp, topic=topic, grade_level=option, role=role,
+                                    history=history)
+        # A verdict which is already known (the same text was flagged before) needs no reply at all
+        blocked = flagged.done() and flagged.result() == True
+        reply = None if blocked else similar_replies.lookup(reply_key, input_text, aiTemp)
+        llm_seconds = None
+        if reply is None and not blocked:
+            try:
+                started = time.perf_counter()
+                with span("llm", model=use_model):
+                    reply = chainSt.invoke({"convo": input_text, "history": history},
+                                           config={"callbacks": [stream, TokenUsageHandler()]})["script"]
+                llm_seconds = time.perf_counter() - started
+            except ReplyWithheld:
+                reply = None
+
+        if reply is None or flagged.result() == True:
             st.write("There is something inappropriate about what you asked.")
 
         else:
-            with st.spinner("Thinking..."):
-                if st.session_state.messages:
-                    for i in range(len(st.session_state.messages)):
-                        if "content" in st.session_state.messages[i] and st.session_state.messages[i]["role"] == "user":
-                            question = st.session_state.messages[i]["content"]
-                        if "content" in st.session_state.messages[i] and st.session_state.messages[i][
-                            "role"] == "assistant":
-                            answer = st.session_state.messages[i]["content"]
-                            memorySt.save_context({"input": question}, {"output": answer})
-                script = chainSt.invoke(input_text)
-            for letter in script["script"]:
-                full_response += letter + ("")
-                time.sleep(0.02)
-                message_placeholder.markdown(full_response + "▌")
-            message_placeholder.markdown(full_response)
-            st.session_state.messages.append({"role": "assistant", "content": full_response})
\ No newline at end of file
+            full_response = stream.finish(reply)
+            if llm_seconds is not None:
+                similar_replies.put(reply_key, input_text, full_response, aiTemp, llm_seconds)
+            # Fold only this exchange into the summary
+            memorySt.add_exchange(model_mem, input_text, full_response)
+            messages.add("assistant", full_response)
\ No newline at end of file
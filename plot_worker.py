@@ -0,0 +1,259 @@
+import io
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import types
+
+# Number of warm worker processes and the limits for one script, can be set from the environment
+PLOT_WORKERS = int(os.environ.get("PLOT_WORKERS", "2"))
+CPU_LIMIT = int(os.environ.get("PLOT_CPU_LIMIT", "20"))
+WALL_LIMIT = int(os.environ.get("PLOT_WALL_LIMIT", "30"))
+# Workers are replaced after this many scripts so leaks in plotting code do not build up
+TASKS_PER_WORKER = 100
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, only the wall clock limit applies there
+    resource = None
+
+
+class ScriptTimeout(Exception):
+    pass
+
+
+class ScriptCrashed(Exception):
+    pass
+
+
+# ---- Runs in the worker processes ----
+
+_registry = None
+
+
+def _raise_timeout(signum, frame):
+    raise ScriptTimeout("The plotting script ran for too long and was stopped.")
+
+
+def _init_worker():
+    # Import the plotting libraries and load the shared datasets once, before any script arrives
+    global _registry
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401
+    import seaborn  # noqa: F401
+    import pandas  # noqa: F401
+    # Calls which would draw more points or categories than an image can show are thinned out first
+    import downsampling
+    downsampling.install()
+    from dataset_registry import registry, BUILTIN_DATASETS
+    _registry = registry
+    for name in BUILTIN_DATASETS:
+        _registry.get("builtin:" + name)
+    if resource is not None:
+        signal.signal(signal.SIGXCPU, _raise_timeout)
+    if hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+
+
+def _set_cpu_limit(seconds):
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if seconds is None:
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime)
+    limit = used + seconds
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+
+
+def _run_script(script, dataset_keys, image_format, cpu_limit, wall_limit):
+    import matplotlib.pyplot as plt
+    from dataset_registry import restore_dtypes
+    # The scripts refer to the datasets by name, e.g. df=datasets["Movies"].copy(), and get them with the
+    # dtypes read_csv gives rather than the compacted ones they are stored with
+    datasets = {name: restore_dtypes(_registry.get(key)) for name, key in dataset_keys.items()}
+    plt.close("all")
+    _set_cpu_limit(cpu_limit)
+    if hasattr(signal, "SIGALRM"):
+        signal.alarm(wall_limit)
+    try:
+        exec(script, {"datasets": datasets, "__name__": "__plot__"})
+        buffer = io.BytesIO()
+        plt.gcf().savefig(buffer, format=image_format, bbox_inches="tight")
+    finally:
+        if hasattr(signal, "SIGALRM"):
+            signal.alarm(0)
+        _set_cpu_limit(None)
+        plt.close("all")
+    return buffer.getvalue()
+
+
+def _serve(conn):
+    # Main loop of a worker process: run the scripts sent over conn one at a time and send back
+    # ("ok", image) or ("error", exception).  Stops when the Streamlit process closes its end.
+    _init_worker()
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            result = ("ok", _run_script(*task))
+        except Exception as error:
+            result = ("error", error)
+        except BaseException as error:
+            # SystemExit and KeyboardInterrupt from a script fail the script, not the worker or the app
+            result = ("error", ScriptCrashed("The plotting script stopped with " + repr(error) + "."))
+        try:
+            conn.send(result)
+        except Exception:
+            # An exception which cannot be pickled is sent as its text
+            conn.send(("error", RuntimeError(type(result[1]).__name__ + ": " + str(result[1]))))
+
+
+# ---- Runs in the Streamlit process ----
+
+# Held while __main__ is swapped out to start a worker
+_start_lock = threading.Lock()
+
+
+class _Worker:
+    # One warm worker process and the pipe to it
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn,), daemon=True, name="plot_worker")
+        # A spawned process first imports the parent's __main__ from its __file__.  Under streamlit run
+        # that is the page itself, which would start workers of its own while the worker boots, so the
+        # worker is started with a __main__ it has nothing to import from.
+        with _start_lock:
+            main = sys.modules.get("__main__")
+            sys.modules["__main__"] = types.ModuleType("__main__")
+            try:
+                self.process.start()
+            finally:
+                sys.modules["__main__"] = main
+        child_conn.close()
+        self.tasks = 0
+
+    def stop(self, kill=False):
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        if kill and self.process.is_alive():
+            self.process.kill()
+        # Reap the process in the background, a worker finishing its last script is not waited for
+        threading.Thread(target=self.process.join, daemon=True).start()
+
+
+class WorkerPool:
+    # Warm worker processes which run one script at a time each.  A worker whose script runs past its
+    # limit, or which dies (os._exit, a crash in a C extension), is replaced on its own: the scripts
+    # other sessions are running in the other workers carry on.
+
+    def __init__(self, size=PLOT_WORKERS, tasks_per_worker=TASKS_PER_WORKER):
+        self.size = max(1, size)
+        self.tasks_per_worker = tasks_per_worker
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = []
+        self._started = 0
+        self._condition = threading.Condition()
+
+    def start(self):
+        # Start the missing workers, they import the plotting libraries while nothing waits for them
+        with self._condition:
+            while self._started < self.size:
+                self._idle.append(_Worker(self._context))
+                self._started += 1
+
+    def close(self):
+        # Stop the idle workers, those running a script are stopped when they are handed back
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._started -= len(idle)
+            self.size = 0
+        for worker in idle:
+            worker.stop()
+
+    def _take(self):
+        with self._condition:
+            while not self._idle and self._started >= self.size:
+                self._condition.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._started += 1
+        try:
+            return _Worker(self._context)
+        except Exception:
+            with self._condition:
+                self._started -= 1
+                self._condition.notify()
+            raise
+
+    def _give_back(self, worker, healthy):
+        worker.tasks += 1
+        if healthy and worker.tasks < self.tasks_per_worker and self.size and worker.process.is_alive():
+            with self._condition:
+                self._idle.append(worker)
+                self._condition.notify()
+            return
+        # Replace the worker straight away so a warm one is ready for the next script
+        worker.stop(kill=not healthy)
+        with self._condition:
+            self._started -= 1
+            self._condition.notify()
+        self.start()
+
+    def run(self, task, timeout):
+        worker = self._take()
+        healthy = False
+        try:
+            try:
+                worker.conn.send(task)
+                # poll returns as soon as the result arrives or the worker's end of the pipe closes
+                if not worker.conn.poll(timeout):
+                    raise ScriptTimeout("The plotting script ran for too long and was stopped.")
+                status, value = worker.conn.recv()
+            except (EOFError, OSError):
+                raise ScriptCrashed("The plotting script stopped its worker process.")
+            healthy = True
+        finally:
+            self._give_back(worker, healthy)
+        if status == "error":
+            raise value
+        return value
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool()
+            _pool.start()
+        return _pool
+
+
+def warm_up():
+    # Start the worker processes ahead of the first script
+    _get_pool()
+
+
+def render_script(script, dataset_keys, image_format="png", cpu_limit=CPU_LIMIT, wall_limit=WALL_LIMIT):
+    # Run a generated plotting script in a worker process and return the figure as PNG or SVG bytes.
+    # dataset_keys maps the dataset names used by the script to their registry keys.
+    # Raises the script's own exception, ScriptTimeout if it runs past its CPU or wall clock limit, or
+    # ScriptCrashed if it takes its worker process down.
+    # The worker stops the script itself at wall_limit, the extra time covers a worker stuck in C code
+    return _get_pool().run((script, dataset_keys, image_format, cpu_limit, wall_limit), wall_limit + 5)
@@ -0,0 +1,199 @@
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+from tracing import span, observe, current_session
+
+# Quota of each model, per minute.  OPENAI_RPM and OPENAI_TPM apply to every model and can be set for
+# one model with its name, e.g. OPENAI_TPM_GPT_4=10000.  0 turns a limit off.
+REQUESTS_PER_MINUTE = int(os.environ.get("OPENAI_RPM", "500"))
+TOKENS_PER_MINUTE = int(os.environ.get("OPENAI_TPM", "30000"))
+# Attempts after the first one for rate limited, timed out and 5xx requests
+MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "5"))
+# Exponential backoff in seconds: BACKOFF_BASE * 2 ** attempt, at most BACKOFF_CAP, half of it random
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+# Tokens counted for a reply whose length is not known yet
+COMPLETION_ESTIMATE = 500
+
+RETRY_STATUS = (408, 409, 429, 500, 502, 503, 504)
+RETRY_ERRORS = ("APITimeoutError", "APIConnectionError", "RateLimitError", "InternalServerError")
+
+
+def estimate_tokens(text):
+    # Rough count of the tokens in text, about four characters each
+    return len(text) // 4 + 1
+
+
+def _model_limit(name, model, default):
+    return int(os.environ.get(name + "_" + model.upper().replace("-", "_").replace(".", "_"), default))
+
+
+class TokenBucket:
+    # Holds up to per_minute units and refills at per_minute / 60 a second.  A limit of 0 never runs out.
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        # Seconds until amount can be taken, a request bigger than the bucket waits for a full one
+        if not self.capacity:
+            return 0.0
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        if self.capacity:
+            self.level -= amount
+
+    def give_back(self, amount):
+        if self.capacity:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    # Shares the quota of one model between the sessions waiting for it.
+    # Waiting requests are queued per session and served round robin, one request per session in
+    # turn, so a session sending many requests only delays its own.
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._condition = threading.Condition()
+        # session -> deque of waiting requests, the session at the front is served next
+        self._queues = OrderedDict()
+        self._paused_until = 0.0
+
+    def acquire(self, tokens=0, session=None):
+        # Block until it is this request's turn and the quota has room for one request of tokens tokens
+        ticket = object()
+        with self._condition:
+            self._queues.setdefault(session, deque()).append(ticket)
+            try:
+                while True:
+                    head = next(iter(self._queues))
+                    if self._queues[head][0] is not ticket:
+                        self._condition.wait()
+                        continue
+                    now = time.monotonic()
+                    delay = max(self._paused_until - now, self.requests.wait_time(1, now),
+                                self.tokens.wait_time(tokens, now))
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                self.requests.take(1)
+                self.tokens.take(tokens)
+            finally:
+                queue = self._queues.pop(session)
+                queue.remove(ticket)
+                if queue:
+                    # Back of the line, behind every other session which is waiting
+                    self._queues[session] = queue
+                self._condition.notify_all()
+
+    def settle(self, estimated, actual):
+        # Correct the token bucket once the real size of a request is known
+        with self._condition:
+            if actual < estimated:
+                self.tokens.give_back(estimated - actual)
+            else:
+                self.tokens.take(actual - estimated)
+            self._condition.notify_all()
+
+    def pause(self, seconds):
+        # Hold every session back after OpenAI said the quota is used up
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._condition.notify_all()
+
+    def waiting(self):
+        with self._condition:
+            return sum(len(queue) for queue in self._queues.values())
+
+
+def _status_code(error):
+    return getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+
+
+def is_retryable(error):
+    return _status_code(error) in RETRY_STATUS or type(error).__name__ in RETRY_ERRORS
+
+
+def retry_after(error):
+    # Seconds OpenAI asked us to wait, from the Retry-After headers, or None
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def backoff(attempt, minimum=None):
+    # Exponential backoff with jitter: half of the delay is fixed, the other half random
+    delay = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    return max(delay, minimum or 0)
+
+
+class Scheduler:
+    # Every request to OpenAI goes through call(), which waits for the model's quota, runs the request
+    # and retries it with backoff when it is rate limited or fails on the way.
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 max_retries=MAX_RETRIES):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, model):
+        with self._lock:
+            if model not in self._limiters:
+                self._limiters[model] = RateLimiter(_model_limit("OPENAI_RPM", model, self.requests_per_minute),
+                                                    _model_limit("OPENAI_TPM", model, self.tokens_per_minute))
+            return self._limiters[model]
+
+    def call(self, func, model, tokens=0, session=None, usage=None):
+        # Run func() once model's quota allows a request of about tokens tokens and return its result.
+        # session defaults to the Streamlit session of the current trace.  usage, if given, returns the
+        # real token count from the result, so the quota is charged what the request actually used.
+        limiter = self.limiter(model)
+        if session is None:
+            session = current_session()
+        attempt = 0
+        while True:
+            with span("queue", model=model, attempt=attempt):
+                limiter.acquire(tokens, session)
+            try:
+                result = func()
+            except Exception as error:
+                if attempt >= self.max_retries or not is_retryable(error):
+                    raise
+                delay = backoff(attempt, retry_after(error))
+                if _status_code(error) == 429:
+                    limiter.pause(delay)
+                observe("backoff", delay)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if usage is not None:
+                actual = usage(result)
+                if actual:
+                    limiter.settle(tokens, actual)
+            return result
+
+
+# Scheduler shared by every session in the process
+scheduler = Scheduler()
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Where the cache lives and how big and how old it may get, can be set from the environment
+CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", os.path.join(".cache", "responses.sqlite"))
+CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "2000"))
+CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_DISABLED = os.environ.get("RESPONSE_CACHE_DISABLED", "") not in ("", "0", "false", "False")
+
+
+def normalize_prompt(prompt):
+    # Collapse whitespace so prompts which only differ in spacing share an entry
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+class ResponseCache:
+    # Disk backed cache of LLM responses keyed on model and normalized prompt.
+    # Keeps at most max_entries responses, dropping the least recently used first,
+    # and treats entries older than ttl seconds as missing.
+
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_SIZE, ttl=CACHE_TTL, disabled=CACHE_DISABLED):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disabled = disabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, "
+                               "response TEXT, created REAL, last_used REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        return self._conn
+
+    @staticmethod
+    def make_key(prompt, model_type):
+        return hashlib.sha256((model_type + "\x1f" + normalize_prompt(prompt)).encode("utf-8")).hexdigest()
+
+    def get(self, prompt, model_type):
+        # Return the cached response or None
+        if self.disabled:
+            return None
+        key = self.make_key(prompt, model_type)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, prompt, model_type, response):
+        if self.disabled:
+            return
+        key = self.make_key(prompt, model_type)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                         (key, model_type, response, now, now))
+            # Evict the least recently used entries beyond the size limit
+            conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                         "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            conn.commit()
+
+    def delete(self, prompt, model_type):
+        # Forget a response, e.g. a script which failed to run
+        if self.disabled:
+            return
+        key = self.make_key(prompt, model_type)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            conn.commit()
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM responses")
+            conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            size = self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "size": size}
+
+
+# Cache shared by every session in the process
+response_cache = ResponseCache()
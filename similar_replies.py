@@ -0,0 +1,210 @@
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from tracing import span, observe
+
+# Where reused replies are kept and how many, can be set from the environment
+SIMILAR_PATH = os.environ.get("SIMILAR_REPLY_PATH", os.path.join(".cache", "similar_replies.sqlite"))
+SIMILAR_SIZE = int(os.environ.get("SIMILAR_REPLY_SIZE", "5000"))
+SIMILAR_TTL = float(os.environ.get("SIMILAR_REPLY_TTL", str(7 * 24 * 3600)))
+# Share of character 4-grams two questions must have in common (Jaccard similarity) for a reply to be reused.
+# High enough that only rewordings pass, "12 times 13" and "12 times 14" already share 0.8 of them.
+SIMILAR_THRESHOLD = float(os.environ.get("SIMILAR_REPLY_THRESHOLD", "0.85"))
+SIMILAR_DISABLED = os.environ.get("SIMILAR_REPLY_DISABLED", "") not in ("", "0", "false", "False")
+
+SHINGLE_SIZE = 4
+# MinHash signature of NUM_HASHES values, split into BANDS bands for locality sensitive hashing:
+# two questions become candidates when all the values of one band match
+NUM_HASHES = 64
+BANDS = 32
+# Candidates compared per lookup, the most recently used first
+MAX_CANDIDATES = 50
+
+_PRIME = (1 << 61) - 1
+_random = random.Random(20240527)
+_PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME)) for _ in range(NUM_HASHES)]
+
+
+def normalize_question(text):
+    # Lower case words without punctuation, so spelling of the same question barely matters
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", text.lower())).strip()
+
+
+def shingles(text):
+    text = " " + normalize_question(text) + " "
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def key_terms(text):
+    # Numbers and names (capitalised words which do not start a sentence), normalized: two questions
+    # which differ in one of them ask for something else however similar the rest is
+    terms = set(re.findall(r"\d+", text))
+    for match in re.finditer(r"(?<![.!?]\s)(?<!^)\b([A-Z][\w'-]*)", text.strip()):
+        if match.group(1) != "I":
+            terms.add(normalize_question(match.group(1)))
+    return terms
+
+
+def same_key_terms(first, second):
+    # Every number and name of each question is also a word of the other one
+    first_words = set(normalize_question(first).split())
+    second_words = set(normalize_question(second).split())
+    return key_terms(first) <= second_words and key_terms(second) <= first_words
+
+
+def jaccard(first, second):
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def minhash(shingle_set):
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") % _PRIME
+              for s in shingle_set]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def band_buckets(signature):
+    # One bucket id per band, small enough for an SQLite integer
+    rows = NUM_HASHES // BANDS
+    buckets = []
+    for band in range(BANDS):
+        values = ",".join(str(v) for v in signature[band * rows:(band + 1) * rows])
+        buckets.append(int.from_bytes(hashlib.blake2b(values.encode("ascii"), digest_size=7).digest(), "big"))
+    return buckets
+
+
+def reply_namespace(page, model, temperature, **persona):
+    # The replies of one page, model, temperature and persona or topic are only reused among themselves.
+    # Pages which send the conversation so far pass it in persona too, a reply is then only reused at the
+    # same point of a conversation (in practice its first message).
+    parts = [page, model, repr(float(temperature))] + [key + "=" + str(persona[key]) for key in sorted(persona)]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class SimilarReplyCache:
+    # Disk backed cache of chat replies which also answers questions that are worded a little differently.
+    # Questions are compared by the Jaccard similarity of their character 4-grams; MinHash signatures
+    # and banded buckets find the candidates without comparing against every stored question.
+    # Replies are only reused at temperature 0, where the model would give (nearly) the same answer.
+
+    def __init__(self, path=SIMILAR_PATH, max_entries=SIMILAR_SIZE, ttl=SIMILAR_TTL,
+                 threshold=SIMILAR_THRESHOLD, disabled=SIMILAR_DISABLED):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.disabled = disabled
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS replies (id INTEGER PRIMARY KEY, namespace TEXT, "
+                               "question TEXT, reply TEXT, seconds REAL, created REAL, last_used REAL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS buckets (namespace TEXT, band INTEGER, bucket INTEGER, "
+                               "reply INTEGER)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS buckets_lookup ON buckets (namespace, band, bucket)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS buckets_reply ON buckets (reply)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS replies_last_used ON replies (last_used)")
+        return self._conn
+
+    def _delete(self, conn, ids):
+        for reply_id in ids:
+            conn.execute("DELETE FROM buckets WHERE reply = ?", (reply_id,))
+            conn.execute("DELETE FROM replies WHERE id = ?", (reply_id,))
+
+    def lookup(self, namespace, question, temperature):
+        # The stored reply to the most similar question at or above the threshold, or None
+        if self.disabled or temperature != 0:
+            return None
+        with span("similar_reply") as attributes:
+            question_shingles = shingles(question)
+            buckets = band_buckets(minhash(question_shingles))
+            now = time.time()
+            with self._lock:
+                conn = self._connect()
+                condition = " OR ".join(["(band = ? AND bucket = ?)"] * BANDS)
+                params = [namespace]
+                for band, bucket in enumerate(buckets):
+                    params.extend([band, bucket])
+                rows = conn.execute(
+                    "SELECT id, question, reply, seconds, created FROM replies WHERE id IN "
+                    "(SELECT reply FROM buckets WHERE namespace = ? AND (" + condition + ")) "
+                    "ORDER BY last_used DESC LIMIT ?", params + [MAX_CANDIDATES]).fetchall()
+                best = None
+                for reply_id, stored_question, reply, seconds, created in rows:
+                    if now - created > self.ttl:
+                        continue
+                    similarity = jaccard(question_shingles, shingles(stored_question))
+                    if (similarity >= self.threshold and (best is None or similarity > best[0])
+                            and same_key_terms(question, stored_question)):
+                        best = (similarity, reply_id, reply, seconds)
+                if best is None:
+                    self.misses += 1
+                    attributes["hit"] = False
+                    return None
+                similarity, reply_id, reply, seconds = best
+                conn.execute("UPDATE replies SET last_used = ? WHERE id = ?", (now, reply_id))
+                conn.commit()
+                self.hits += 1
+                self.saved_seconds += seconds
+            attributes.update(hit=True, similarity=round(similarity, 3), saved_seconds=round(seconds, 3))
+        # The time the model took for the stored reply, which this lookup did not have to wait for
+        observe("similar_reply_saved", seconds)
+        return reply
+
+    def put(self, namespace, question, reply, temperature, seconds):
+        # Remember a reply which took the model seconds to write, only replies at temperature 0 are kept
+        if self.disabled or temperature != 0:
+            return
+        buckets = band_buckets(minhash(shingles(question)))
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            reply_id = conn.execute("INSERT INTO replies (namespace, question, reply, seconds, created, last_used) "
+                                    "VALUES (?, ?, ?, ?, ?, ?)",
+                                    (namespace, question, reply, seconds, now, now)).lastrowid
+            conn.executemany("INSERT INTO buckets VALUES (?, ?, ?, ?)",
+                             [(namespace, band, bucket, reply_id) for band, bucket in enumerate(buckets)])
+            # Drop the least recently used replies beyond the size limit, and the expired ones
+            stale = conn.execute("SELECT id FROM replies ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+                                 (self.max_entries,)).fetchall()
+            stale += conn.execute("SELECT id FROM replies WHERE created < ?", (now - self.ttl,)).fetchall()
+            self._delete(conn, {row[0] for row in stale})
+            conn.commit()
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM buckets")
+            conn.execute("DELETE FROM replies")
+            conn.commit()
+            self.hits = 0
+            self.misses = 0
+            self.saved_seconds = 0.0
+
+    def stats(self):
+        with self._lock:
+            size = self._connect().execute("SELECT COUNT(*) FROM replies").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "saved_seconds": round(self.saved_seconds, 3), "size": size}
+
+
+# Cache shared by every session in the process
+similar_replies = SimilarReplyCache()
@@ -0,0 +1,178 @@
+import threading
+from concurrent.futures import Future
+
+from tracing import span, run_in_context
+
+
+class SharedStream:
+    # The chunks of one streamed reply, read by every caller which asked for the same reply.
+    # One background thread reads the upstream stream; each reader replays the chunks received
+    # so far and then follows along at its own pace.
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self._condition = threading.Condition()
+
+    def _add(self, chunk):
+        with self._condition:
+            self.chunks.append(chunk)
+            self._condition.notify_all()
+
+    def _finish(self, error=None):
+        with self._condition:
+            self.done = True
+            self.error = error
+            self._condition.notify_all()
+
+    def read(self, shared=None):
+        # A new reader, counted from now until it is read to the end, closed or dropped.
+        # shared, if given, is applied to each chunk it returns.
+        with self._condition:
+            self.readers += 1
+        return _Reader(self, shared)
+
+    def _follow(self):
+        index = 0
+        while True:
+            with self._condition:
+                while index >= len(self.chunks) and not self.done:
+                    self._condition.wait()
+                if index < len(self.chunks):
+                    chunk = self.chunks[index]
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            index += 1
+            yield chunk
+
+    def _leave(self):
+        with self._condition:
+            self.readers -= 1
+
+
+class _Reader:
+    # One caller's iterator over a SharedStream.  Unlike a generator it also stops counting as a reader
+    # when it is closed or dropped before its first chunk, so an unread stream is still seen as abandoned.
+
+    def __init__(self, stream, shared=None):
+        self._stream = stream
+        self._shared = shared
+        self._chunks = stream._follow()
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        try:
+            chunk = next(self._chunks)
+        except BaseException:
+            self.close()
+            raise
+        return self._shared(chunk) if self._shared is not None else chunk
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._chunks.close()
+            self._stream._leave()
+
+    def __del__(self):
+        self.close()
+
+
+class SingleFlight:
+    # Coalesces identical requests which are in flight at the same time: the first caller for a key
+    # runs the request, callers arriving before it finishes wait for it and get the same result
+    # (or the same exception) instead of sending the request again.
+
+    def __init__(self):
+        self.led = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, shared=None):
+        # Return func(), or the result of the call for key already in flight.
+        # shared, if given, is applied to the result handed to the callers who waited.
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.led += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            with span("single_flight", shared=True):
+                result = future.result()
+            return shared(result) if shared is not None else result
+        try:
+            result = func()
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stream(self, key, start, shared=None):
+        # Iterate over the chunks of start(), or of the stream for key already in flight.
+        # shared, if given, is applied to each chunk handed to the callers who joined.
+        # The upstream stream is read to the end as long as someone is reading, and closed once
+        # every reader has stopped.
+        with self._lock:
+            stream = self._streams.get(key)
+            leader = stream is None
+            if leader:
+                stream = self._streams[key] = SharedStream()
+                self.led += 1
+            else:
+                self.coalesced += 1
+            # Counted as a reader before the feed starts, so the stream is not taken for abandoned
+            reader = stream.read(None if leader else shared)
+        if leader:
+            threading.Thread(target=run_in_context(self._feed), args=(key, stream, start), daemon=True,
+                             name="single_flight").start()
+        return reader
+
+    def _feed(self, key, stream, start):
+        error = None
+        chunks = None
+        try:
+            chunks = start()
+            for chunk in chunks:
+                with self._lock:
+                    if not stream.readers:
+                        # Nobody is reading any more, new callers start a request of their own
+                        del self._streams[key]
+                        key = None
+                        break
+                stream._add(chunk)
+        except BaseException as caught:
+            error = caught
+        finally:
+            if key is not None:
+                with self._lock:
+                    del self._streams[key]
+            if chunks is not None and hasattr(chunks, "close"):
+                chunks.close()
+            stream._finish(error)
+
+    def stats(self):
+        with self._lock:
+            return {"led": self.led, "coalesced": self.coalesced, "in_flight": len(self._calls) + len(self._streams)}
+
+
+# Requests in flight in the process, shared by every session
+single_flight = SingleFlight()
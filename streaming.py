@@ -0,0 +1,77 @@
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from tracing import annotate, observe, record_tokens
+
+# Seconds between redraws of a streamed reply, tokens arriving in between are drawn together
+RENDER_INTERVAL = 0.05
+
+
+class ReplyWithheld(Exception):
+    # Raised from the stream to stop generating a reply which must not be shown
+    pass
+
+
+class StreamHandler(BaseCallbackHandler):
+    # Writes tokens into a Streamlit placeholder as the model produces them.
+    # Pass it in the callbacks of chain.invoke(..., config={"callbacks": [handler]}) with a
+    # chat model created with streaming=True, then call finish() once the chain returns.
+    # If gate is given (a Future, e.g. from moderation.check_async) nothing is drawn until it
+    # resolves, and the generation is stopped with ReplyWithheld if it resolves to True.
+
+    # Let ReplyWithheld stop the chain instead of being logged and ignored
+    raise_error = True
+
+    def __init__(self, placeholder, interval=RENDER_INTERVAL, gate=None):
+        self.placeholder = placeholder
+        self.interval = interval
+        self.gate = gate
+        self.text = ""
+        self._last_render = 0.0
+        self._started = time.perf_counter()
+
+    def on_llm_new_token(self, token, **kwargs):
+        if not self.text and token:
+            first_token = time.perf_counter() - self._started
+            observe("first_token", first_token)
+            annotate(first_token_seconds=round(first_token, 6))
+        self.text += token
+        if self.gate is not None:
+            if not self.gate.done():
+                # Hold the reply back until the gate opens
+                return
+            if self.gate.result():
+                raise ReplyWithheld()
+        now = time.monotonic()
+        if now - self._last_render >= self.interval:
+            self._last_render = now
+            self.placeholder.markdown(self.text + "▌")
+
+    def finish(self, text=None):
+        # Draw the final reply without the cursor, text replaces what was streamed if given
+        if text is not None:
+            self.text = text
+        self.placeholder.markdown(self.text)
+        return self.text
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    # LangChain callback which records the token usage of every chat model call in the current trace
+
+    def on_llm_end(self, response, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        model = (response.llm_output or {}).get("model_name", "unknown")
+        if not usage:
+            # Streamed replies carry their usage on the message instead
+            for generations in response.generations:
+                for generation in generations:
+                    message = getattr(generation, "message", None)
+                    metadata = getattr(message, "usage_metadata", None) or {}
+                    prompt_tokens += metadata.get("input_tokens", 0)
+                    completion_tokens += metadata.get("output_tokens", 0)
+                    model = (getattr(message, "response_metadata", None) or {}).get("model_name", model)
+        if prompt_tokens or completion_tokens:
+            record_tokens(model, prompt_tokens, completion_tokens)
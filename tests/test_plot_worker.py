@@ -0,0 +1,46 @@
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import plot_worker  # noqa: E402
+
+SCRIPT = "import matplotlib.pyplot as plt\nfig, ax = plt.subplots()\nax.plot(datasets['Cars']['MPG'])\n"
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    # The workers load the bundled datasets relative to the app directory
+    monkeypatch.chdir(ROOT)
+    pool = plot_worker.WorkerPool(size=1)
+    yield pool
+    pool.close()
+
+
+def _render(pool, script=SCRIPT):
+    return pool.run((script, {"Cars": "builtin:Cars"}, "png", 20, 30), 35)
+
+
+def test_render(pool):
+    assert _render(pool).startswith(b"\x89PNG")
+
+
+def test_render_under_streamlit_main(pool, monkeypatch, tmp_path):
+    # streamlit run makes the page __main__, the workers must start without importing it
+    page = tmp_path / "page.py"
+    page.write_text("import plot_worker\nplot_worker.warm_up()\nraise RuntimeError('the page was imported')\n")
+    main = types.ModuleType("__main__")
+    main.__file__ = str(page)
+    monkeypatch.setitem(sys.modules, "__main__", main)
+    assert _render(pool).startswith(b"\x89PNG")
+    assert sys.modules["__main__"] is main
+
+
+def test_dead_worker_is_replaced(pool):
+    with pytest.raises(plot_worker.ScriptCrashed):
+        _render(pool, "import os\nos._exit(1)\n")
+    assert _render(pool).startswith(b"\x89PNG")
@@ -0,0 +1,235 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Where finished traces are appended, one JSON object per line, and where metrics are served
+TRACE_LOG = os.environ.get("TRACE_LOG", os.path.join("logs", "traces.jsonl"))
+# The log is rotated at this size, like logging.handlers.RotatingFileHandler: traces.jsonl.1 is the
+# newest old file and files beyond TRACE_LOG_BACKUPS are deleted
+TRACE_LOG_MAX_MB = float(os.environ.get("TRACE_LOG_MAX_MB", "10"))
+TRACE_LOG_BACKUPS = int(os.environ.get("TRACE_LOG_BACKUPS", "3"))
+# Only reachable from this machine unless METRICS_HOST says otherwise, e.g. 0.0.0.0 for a scraper
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+METRICS_PREFIX = "aiactivities_"
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_log_lock = threading.Lock()
+
+
+class _Metrics:
+    # Totals since the process started, exported in the Prometheus text format
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.span_seconds = {}
+        self.span_count = {}
+        self.tokens = {}
+        self.traces = {}
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.span_seconds[name] = self.span_seconds.get(name, 0.0) + seconds
+            self.span_count[name] = self.span_count.get(name, 0) + 1
+
+    def add_tokens(self, model, kind, count):
+        with self._lock:
+            self.tokens[(model, kind)] = self.tokens.get((model, kind), 0) + count
+
+    def add_trace(self, kind):
+        with self._lock:
+            self.traces[kind] = self.traces.get(kind, 0) + 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines.append("# TYPE " + METRICS_PREFIX + "span_seconds summary")
+            for name in sorted(self.span_seconds):
+                lines.append('%sspan_seconds_sum{span="%s"} %.6f' % (METRICS_PREFIX, name, self.span_seconds[name]))
+                lines.append('%sspan_seconds_count{span="%s"} %d' % (METRICS_PREFIX, name, self.span_count[name]))
+            lines.append("# TYPE " + METRICS_PREFIX + "tokens_total counter")
+            for (model, kind), count in sorted(self.tokens.items()):
+                lines.append('%stokens_total{model="%s",kind="%s"} %d' % (METRICS_PREFIX, model, kind, count))
+            lines.append("# TYPE " + METRICS_PREFIX + "traces_total counter")
+            for kind, count in sorted(self.traces.items()):
+                lines.append('%straces_total{kind="%s"} %d' % (METRICS_PREFIX, kind, count))
+        return "\n".join(lines) + "\n"
+
+
+metrics = _Metrics()
+
+
+class Trace:
+    # Timed spans and token counts of one request (a chat turn or a Go... click) in one session
+
+    def __init__(self, kind, session_id):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.session_id = session_id
+        self.start = time.time()
+        self.spans = []
+        self.tokens = {}
+        self.attributes = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, seconds, attributes):
+        with self._lock:
+            self.spans.append({"name": name, "offset": round(start - self.start, 6),
+                               "seconds": round(seconds, 6), **attributes})
+
+    def add_tokens(self, model, prompt_tokens, completion_tokens):
+        with self._lock:
+            usage = self.tokens.setdefault(model, {"prompt": 0, "completion": 0})
+            usage["prompt"] += prompt_tokens
+            usage["completion"] += completion_tokens
+
+    def to_dict(self):
+        with self._lock:
+            return {"trace": self.id, "kind": self.kind, "session": self.session_id,
+                    "start": self.start, "seconds": round(time.time() - self.start, 6),
+                    "spans": list(self.spans), "tokens": dict(self.tokens), **self.attributes}
+
+
+def session_id():
+    # The Streamlit session running this script, or None outside Streamlit
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        # Called from worker threads and batch runs too, where there is no session to warn about
+        ctx = get_script_run_ctx(suppress_warning=True)
+        return ctx.session_id if ctx is not None else None
+    except Exception:
+        return None
+
+
+def current_session():
+    # Session of the current trace, which is also known in threads started through run_in_context
+    current = _current_trace.get()
+    if current is not None and current.session_id is not None:
+        return current.session_id
+    return session_id()
+
+
+@contextmanager
+def trace(kind, session=None):
+    # Collect every span recorded inside the block, in this thread or in threads started
+    # through run_in_context, and append them to TRACE_LOG when the block ends
+    current = Trace(kind, session if session is not None else session_id())
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        metrics.add_trace(kind)
+        metrics.observe(kind, time.time() - current.start)
+        _write(current.to_dict())
+
+
+@contextmanager
+def span(name, **attributes):
+    # Time the block, as part of the current trace if there is one and in the process metrics
+    start = time.time()
+    began = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        seconds = time.perf_counter() - began
+        metrics.observe(name, seconds)
+        current = _current_trace.get()
+        if current is not None:
+            current.add_span(name, start, seconds, attributes)
+
+
+def observe(name, seconds):
+    # Record a duration measured elsewhere, e.g. work done in a background thread
+    metrics.observe(name, seconds)
+
+
+def annotate(**attributes):
+    # Add attributes to the current trace
+    current = _current_trace.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def record_tokens(model, prompt_tokens, completion_tokens):
+    metrics.add_tokens(model, "prompt", prompt_tokens)
+    metrics.add_tokens(model, "completion", completion_tokens)
+    current = _current_trace.get()
+    if current is not None:
+        current.add_tokens(model, prompt_tokens, completion_tokens)
+
+
+def run_in_context(func):
+    # Wrap func so it runs inside the caller's trace when handed to a thread pool
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+
+def _rotate():
+    # Called with _log_lock held: traces.jsonl.1 -> .2 ..., traces.jsonl -> .1
+    for number in range(TRACE_LOG_BACKUPS - 1, 0, -1):
+        older = TRACE_LOG + "." + str(number)
+        if os.path.exists(older):
+            os.replace(older, TRACE_LOG + "." + str(number + 1))
+    if TRACE_LOG_BACKUPS > 0:
+        os.replace(TRACE_LOG, TRACE_LOG + ".1")
+    else:
+        os.remove(TRACE_LOG)
+
+
+def _write(record):
+    try:
+        directory = os.path.dirname(TRACE_LOG)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with _log_lock:
+            if os.path.exists(TRACE_LOG) and os.path.getsize(TRACE_LOG) >= TRACE_LOG_MAX_MB * 1024 * 1024:
+                _rotate()
+            with open(TRACE_LOG, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+    except Exception as e:
+        # Tracing must never break a request
+        print("Trace log write failed.\n" + str(e))
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics_server = None
+_metrics_lock = threading.Lock()
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    # Serve the metrics on http://<host>:<port>/metrics, once per process. METRICS_PORT=0 turns it off.
+    global _metrics_server
+    if not port:
+        return
+    with _metrics_lock:
+        if _metrics_server is not None:
+            return
+        try:
+            _metrics_server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        except OSError as e:
+            print("Metrics server could not start on " + host + ":" + str(port) + ".\n" + str(e))
+            _metrics_server = False
+            return
+        threading.Thread(target=_metrics_server.serve_forever, name="metrics", daemon=True).start()